@@ -0,0 +1,319 @@
+#!/usr/bin/env python2
+# encoding: utf-8
+"""
+Benchmark the hot paths of the status pipeline.
+
+Runs offline against a temporary run directory (set through PBAPPS_ROOT).
+For every operation it reports latency percentiles, the number of
+read/write class syscalls (from /proc/self/io) and the net number of
+allocated objects per call.
+"""
+
+from __future__ import division, print_function, unicode_literals
+
+__author__ = "Parantapa Bhattachara <pb [at] parantapa [dot] net>"
+
+import os
+import sys
+import gc
+import imp
+import json
+import shutil
+import signal
+import tempfile
+import argparse
+from os.path import join, dirname, abspath
+from timeit import default_timer as timer
+
+import pbapps_common as common
+import i3status
+
+SRCDIR = dirname(abspath(__file__))
+
+SAMPLE_BLOCKS = [
+    {"name": "mem_usage", "instance": 0, "full_text": "M 42%",
+     "color": "#a6e22e"},
+    {"name": "cpu_usage", "instance": 0, "full_text": "C  3%  7%  1%  0%",
+     "color": "#a6e22e"},
+    {"name": "date", "instance": "date",
+     "full_text": "Sun, Oct 18 2026 10:00:00 AM"},
+]
+
+SAMPLE_URLS = [
+    "http://i.imgur.com/abcdefg.jpg",
+    "https://imgur.com/abcdefg",
+    "https://imgur.com/a/abcdefg",
+    "https://i.redd.it/abcdefghijk.png",
+    "https://www.flickr.com/photos/someone/123456789/",
+    "http://example.com/image.JPEG",
+    "https://gfycat.com/SomeAnimatedThing",
+    "https://www.reddit.com/r/EarthPorn/comments/abc/title/",
+] * 12
+
+def load_script(name):
+    """
+    Import one of the scripts.
+    """
+
+    fname = join(SRCDIR, name + ".py")
+    return imp.load_source(name.replace("-", "_"), fname)
+
+def read_syscalls():
+    """
+    Get the number of read and write class syscalls made so far.
+    """
+
+    try:
+        with open("/proc/self/io", "r") as fobj:
+            lines = fobj.readlines()
+    except IOError:
+        return 0
+
+    count = 0
+    for line in lines:
+        key, _, val = line.partition(":")
+        if key in ("syscr", "syscw"):
+            count += int(val)
+    return count
+
+def read_allocs():
+    """
+    Get the number of currently allocated objects.
+
+    Python 2 has no allocation counter; with the garbage collector
+    disabled gc.get_count() counts the net container allocations.
+    """
+
+    if hasattr(sys, "getallocatedblocks"):
+        return sys.getallocatedblocks()
+    return gc.get_count()[0]
+
+def percentile(values, pct):
+    """
+    Get the pct-th percentile of the sorted values.
+    """
+
+    idx = int(round(pct / 100 * (len(values) - 1)))
+    return values[idx]
+
+def bench(name, func, repeat, setup=None):
+    """
+    Run func repeat times; setup is run untimed before each call.
+
+    Returns a result row.
+    """
+
+    if setup is not None:
+        setup()
+    func()
+
+    # Cost of the measurement itself
+    sys_base = read_syscalls()
+    sys_base = read_syscalls() - sys_base
+
+    times, syscalls, allocs = [], 0, 0
+    gc.collect()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            if setup is not None:
+                setup()
+
+            sys0 = read_syscalls()
+            alloc0 = read_allocs()
+            t0 = timer()
+            func()
+            t1 = timer()
+            alloc1 = read_allocs()
+            sys1 = read_syscalls()
+
+            times.append(t1 - t0)
+            syscalls += sys1 - sys0 - sys_base
+            allocs += alloc1 - alloc0
+    finally:
+        gc.enable()
+
+    times.sort()
+    return (name,
+            repeat,
+            percentile(times, 50) * 1e6,
+            percentile(times, 90) * 1e6,
+            percentile(times, 99) * 1e6,
+            times[-1] * 1e6,
+            syscalls / repeat,
+            allocs / repeat)
+
+def print_results(rows):
+    """
+    Print the result rows as a table.
+    """
+
+    hdr = ("operation", "n", "p50 us", "p90 us", "p99 us", "max us",
+           "sys/op", "alloc/op")
+    fmt = "{:<40} {:>6} {:>10} {:>10} {:>10} {:>10} {:>8} {:>9}"
+    print(fmt.format(*hdr))
+    for name, n, p50, p90, p99, pmax, sysc, alloc in rows:
+        print(fmt.format(name, n,
+                         "%.1f" % p50, "%.1f" % p90, "%.1f" % p99,
+                         "%.1f" % pmax, "%.1f" % sysc, "%.1f" % alloc))
+    sys.stdout.flush()
+
+def make_producers(extdir, count):
+    """
+    Create the .pid and .block files of count live producers.
+    """
+
+    for fname in os.listdir(extdir):
+        os.remove(join(extdir, fname))
+
+    pid = str(os.getpid())
+    for i in range(count):
+        service = "%03dbench-%d" % (i % 100, i)
+        with open("%s/%s.pid" % (extdir, service), "w") as fobj:
+            fobj.write(pid)
+        with open("%s/%s.block" % (extdir, service), "w") as fobj:
+            json.dump(SAMPLE_BLOCKS, fobj)
+
+def bench_i3status(sizes, repeat):
+    """
+    Benchmark reading the blocks of the producers.
+    """
+
+    extdir = common.get_i3status_rundir()
+    rows = []
+    for count in sizes:
+        make_producers(extdir, count)
+
+        rows.append(bench("read_blocks uncached [%d]" % count,
+                          lambda: i3status.read_blocks(extdir),
+                          repeat))
+
+        cache = i3status.BlockCache(extdir)
+        rows.append(bench("status_line unchanged [%d]" % count,
+                          cache.status_line, repeat))
+
+        publisher = common.BlockPublisher(extdir, 0, "bench-0")
+        state = {"i": 0}
+        def change_one():
+            state["i"] += 1
+            blocks = [{"full_text": "update %d" % state["i"]}]
+            publisher.write(blocks)
+        rows.append(bench("status_line one changed [%d]" % count,
+                          cache.status_line, repeat, change_one))
+
+    return rows
+
+def bench_publish(repeat):
+    """
+    Benchmark the producer side of a block update.
+    """
+
+    extdir = common.get_i3status_rundir()
+    make_producers(extdir, 1)
+
+    publisher = common.BlockPublisher(extdir, 0, "bench-0")
+    sock = i3status.open_socket(common.get_i3status_sockname())
+    cache = i3status.BlockCache(extdir)
+
+    rows = []
+    rows.append(bench("BlockPublisher.write (file)",
+                      lambda: publisher.write(SAMPLE_BLOCKS), repeat))
+    rows.append(bench("BlockPublisher.send (socket)",
+                      lambda: publisher.send(SAMPLE_BLOCKS), repeat,
+                      lambda: i3status.read_socket(sock, cache)))
+    rows.append(bench("read_socket (1 message)",
+                      lambda: i3status.read_socket(sock, cache), repeat,
+                      lambda: publisher.send(SAMPLE_BLOCKS)))
+
+    sock.close()
+    return rows
+
+def bench_wake(repeat):
+    """
+    Benchmark waking up i3status; we play i3status ourselves.
+    """
+
+    signal.signal(signal.SIGUSR1, common.dummy_handler)
+    with open(common.get_rundir() + "/i3status.pid", "w") as fobj:
+        fobj.write(str(os.getpid()))
+
+    def forget_pid():
+        common.I3STATUS_PID = None
+
+    rows = []
+    rows.append(bench("wake_i3status (pid cached)",
+                      common.wake_i3status, repeat))
+    rows.append(bench("wake_i3status (pid read)",
+                      common.wake_i3status, repeat, forget_pid))
+    return rows
+
+def bench_periods(repeat):
+    """
+    Benchmark the time period helpers.
+    """
+
+    rows = []
+    rows.append(bench("parse_period",
+                      lambda: common.parse_period("1d 2h 30m 15s"), repeat))
+    rows.append(bench("fmt_period",
+                      lambda: common.fmt_period(95415), repeat))
+    return rows
+
+def bench_reddit(repeat):
+    """
+    Benchmark the reddit-bg url classifier.
+    """
+
+    try:
+        reddit = load_script("reddit-bg")
+    except ImportError as e:
+        print("Skipping reddit-bg: %s" % e)
+        return []
+
+    def filter_urls():
+        urls = [reddit.classify_url(u) for u in SAMPLE_URLS]
+        return [url for is_image, url, _ in urls if is_image]
+
+    rows = []
+    for url in SAMPLE_URLS[:8]:
+        rows.append(bench("classify_url %s" % url[:27],
+                          lambda u=url: reddit.classify_url(u), repeat))
+
+    n = len(SAMPLE_URLS)
+    rows.append(bench("reddit-bg url filters [%d urls]" % n,
+                      filter_urls, repeat))
+    return rows
+
+def parse_args():
+    """
+    Parse the command line arguments.
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", default="10,100,1000",
+                        help="numbers of producers (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=200,
+                        help="calls per operation (default: %(default)s)")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    sizes = [int(s) for s in args.sizes.split(",")]
+
+    root = tempfile.mkdtemp(prefix="pbapps-bench-")
+    os.environ["PBAPPS_ROOT"] = root
+    os.environ.setdefault("UID", str(os.getuid()))
+
+    try:
+        rows = []
+        rows += bench_i3status(sizes, args.repeat)
+        rows += bench_publish(args.repeat)
+        rows += bench_wake(args.repeat)
+        rows += bench_periods(args.repeat)
+        rows += bench_reddit(args.repeat)
+        print_results(rows)
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == '__main__':
+    main()
@@ -8,57 +8,396 @@ from __future__ import division, print_function, unicode_literals
 
 __author__ = "Parantapa Bhattachara <pb [at] parantapa [dot] net>"
 
-import time
-import subprocess as sub
+import os
+from os.path import join, isfile, basename, normpath
+from multiprocessing.pool import ThreadPool
+
+import logbook
 
 from pypb import abspath
-from pbapps_common import do_main
+from pbapps_common import do_main, periodic_iter, run_command, \
+                          Inotify, IN_CREATE, IN_DELETE, IN_CLOSE_WRITE, \
+                          IN_MOVED_FROM, IN_MOVED_TO, IN_ISDIR, \
+                          IN_IGNORED, IN_Q_OVERFLOW
 
 MODULE = "git-multi-status"
+PRIO = 15
+PERIOD = 2
+
+# Time given to git status before the repo is shown as unknown
+CMD_TIMEOUT = 5
+
+# Number of repos checked in parallel
+WORKERS = 8
 
 C_WHITE = "#f8f8f2"
 C_RED = "#f92672"
 
 REPO_DIRS = abspath("~/.repo-dirs")
 
-def get_git_status():
+WORKTREE_MASK = (IN_CREATE | IN_DELETE | IN_CLOSE_WRITE
+                 | IN_MOVED_FROM | IN_MOVED_TO)
+
+# Repos needing more directory watches than this are checked every time
+MAX_REPO_WATCHES = 2000
+
+log = logbook.Logger(MODULE)
+
+def read_repo_dirs():
     """
-    Get git status.
+    Read the list of repos to check.
     """
 
     with open(REPO_DIRS, "r") as fobj:
         lines = fobj.readlines()
     lines = [l.strip() for l in lines]
+    lines = [abspath(l) for l in lines if l]
+    return lines
+
+def get_git_dir(repo):
+    """
+    Get the git directory of repo; .git may point elsewhere.
+    """
+
+    gdir = join(repo, ".git")
+    if isfile(gdir):
+        with open(gdir, "r") as fobj:
+            line = fobj.read().strip()
+        if line.startswith("gitdir:"):
+            gdir = normpath(join(repo, line[len("gitdir:"):].strip()))
+    return gdir
+
+def repo_fingerprint(repo):
+    """
+    Get the mtimes of HEAD, index and the refs of repo.
+
+    Refs are updated by renaming into place, so the mtimes of the
+    directories under refs change whenever a ref does.
+    """
+
+    gdir = get_git_dir(repo)
+
+    fp = []
+    for name in ("HEAD", "index", "packed-refs"):
+        try:
+            fp.append(os.stat(join(gdir, name)).st_mtime)
+        except OSError:
+            fp.append(None)
+
+    for root, _, _ in os.walk(join(gdir, "refs")):
+        try:
+            fp.append((root, os.stat(root).st_mtime))
+        except OSError:
+            pass
+
+    return tuple(fp)
+
+def ignored_dirs(repo, tops):
+    """
+    Get the directories under tops that git ignores, e.g. node_modules.
+
+    Nothing in them shows up in git status, so they need no watches.
+    """
+
+    cmd = ["git", "--no-optional-locks", "-C", repo,
+           "ls-files", "--others", "--ignored", "--exclude-standard",
+           "--directory", "-z", "--"] + tops
+    retcode, out = run_command(cmd, CMD_TIMEOUT)
+    if retcode != 0:
+        return set()
+    paths = [p for p in out.decode("utf-8").split("\0") if p.endswith("/")]
+    if not paths:
+        return set()
+
+    # ls-files also lists untracked directories holding only ignored
+    # files; new files in those do show up.
+    cmd = ["git", "--no-optional-locks", "-C", repo,
+           "-c", "core.quotePath=false", "check-ignore", "--"] + paths
+    retcode, out = run_command(cmd, CMD_TIMEOUT)
+    if retcode not in (0, 1):
+        return set()
+
+    paths = out.decode("utf-8").split("\n")
+    return set(normpath(join(repo, p)) for p in paths if p)
+
+def parse_status(text):
+    """
+    Parse the output of git status --porcelain -b.
+
+    ## master...origin/master [ahead 1, behind 2]
+     M pbapps_common.py
+
+    Returns (dirty, ahead, behind).
+    """
+
+    lines = text.split("\n")
     lines = [l for l in lines if l]
 
-    cmd = ["git-multi-status"] + lines
-    try:
-        status = sub.check_output(cmd).strip()
-    except sub.CalledProcessError:
-        status = None
+    ahead, behind = False, False
+    if lines and lines[0].startswith("## "):
+        head = lines.pop(0)
+        ahead = "[ahead " in head or ", ahead " in head
+        behind = "behind " in head
+
+    dirty = bool(lines)
+    return dirty, ahead, behind
+
+def check_repo(repo):
+    """
+    Get the status of repo; None if git failed.
+    """
+
+    cmd = ["git", "--no-optional-locks", "-C", repo,
+           "status", "--porcelain", "-b"]
+    retcode, out = run_command(cmd, CMD_TIMEOUT)
+    if retcode != 0:
+        return None
 
+    return parse_status(out.decode("utf-8"))
+
+def fmt_status(repo, status):
+    """
+    Format the status of repo; None if there is nothing to show.
+    """
+
+    name = basename(repo.rstrip("/"))
     if status is None:
+        return name + "??"
+
+    dirty, ahead, behind = status
+    flags = ""
+    if dirty:
+        flags += "*"
+    if ahead:
+        flags += "↑"
+    if behind:
+        flags += "↓"
+
+    if not flags:
+        return None
+    return name + flags
+
+class GitStatusEngine(object):
+    """
+    Check the repos in parallel, skipping those that didn't change.
+
+    A repo is checked again only if its HEAD, index or refs changed or
+    inotify saw something happen in its worktree.
+    """
+
+    def __init__(self):
+        self.pool = ThreadPool(WORKERS)
+
+        try:
+            self.inotify = Inotify()
+        except OSError:
+            log.warn("inotify not available; checking every repo",
+                     exc_info=True)
+            self.inotify = None
+
+        # wd -> (repo, path)
+        self.watches = {}
+
+        # repo -> number of watches
+        self.nwatches = {}
+
+        # Repos that couldn't be watched fully, e.g. out of watches
+        self.unwatched = set()
+
+        # Repos whose worktree changed since last check
+        self.dirty = set()
+
+        # repo -> (fingerprint, status)
+        self.cache = {}
+
+        self.repos = []
+        self.repo_dirs_mtime = None
+
+    def watch_tree(self, repo, tops):
+        """
+        Watch the directories under tops, skipping .git and ignored ones.
+
+        Repos that can't be watched fully are checked every time.
+        """
+
+        if self.inotify is None or repo in self.unwatched:
+            return
+
+        ignored = ignored_dirs(repo, tops)
+        for top in tops:
+            for root, dirs, _ in os.walk(top):
+                if root in ignored:
+                    dirs[:] = []
+                    continue
+                if ".git" in dirs:
+                    dirs.remove(".git")
+
+                if self.nwatches.get(repo, 0) >= MAX_REPO_WATCHES:
+                    log.warn("{} has over {} directories; will check it "
+                             "every time", repo, MAX_REPO_WATCHES)
+                    self.give_up(repo)
+                    return
+
+                try:
+                    wd = self.inotify.add_watch(root, WORKTREE_MASK)
+                except OSError:
+                    log.warn("Can't watch {}; will check it every time",
+                             root)
+                    self.give_up(repo)
+                    return
+                if wd not in self.watches:
+                    self.nwatches[repo] = self.nwatches.get(repo, 0) + 1
+                self.watches[wd] = (repo, root)
+
+    def give_up(self, repo):
+        """
+        Check repo every time instead of watching it.
+        """
+
+        self.unwatch(repo)
+        self.unwatched.add(repo)
+
+    def unwatch(self, repo):
+        """
+        Remove the watches of repo.
+        """
+
+        for wd, (wrepo, _) in list(self.watches.items()):
+            if wrepo == repo:
+                self.inotify.rm_watch(wd)
+                del self.watches[wd]
+        self.nwatches.pop(repo, None)
+
+    def update_repos(self):
+        """
+        Re-read the list of repos if it changed.
+        """
+
+        mtime = os.stat(REPO_DIRS).st_mtime
+        if mtime == self.repo_dirs_mtime:
+            return
+        self.repo_dirs_mtime = mtime
+
+        repos = read_repo_dirs()
+        for repo in set(self.repos).difference(repos):
+            if self.inotify is not None:
+                self.unwatch(repo)
+            self.unwatched.discard(repo)
+            self.dirty.discard(repo)
+            self.cache.pop(repo, None)
+        for repo in set(repos).difference(self.repos):
+            self.watch_tree(repo, [repo])
+
+        self.repos = repos
+
+    def read_events(self):
+        """
+        Mark the repos whose worktree changed.
+        """
+
+        # repo -> new directories
+        new_dirs = {}
+
+        for wd, mask, _, name in self.inotify.read():
+            if mask & IN_Q_OVERFLOW:
+                self.dirty.update(self.repos)
+                continue
+
+            entry = self.watches.get(wd)
+            if entry is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.watches[wd]
+                self.nwatches[entry[0]] -= 1
+                continue
+
+            repo, path = entry
+            if name == ".git":
+                continue
+            self.dirty.add(repo)
+
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                new_dirs.setdefault(repo, []).append(join(path, name))
+
+        for repo, tops in new_dirs.items():
+            self.watch_tree(repo, tops)
+
+    def needs_check(self, repo, fp):
+        """
+        Check if the cached status of repo may be stale.
+        """
+
+        if self.inotify is None:
+            return True
+        if repo in self.dirty or repo in self.unwatched:
+            return True
+
+        # Failed checks are always retried
+        entry = self.cache.get(repo)
+        return entry is None or entry[1] is None or entry[0] != fp
+
+    def statuses(self):
+        """
+        Get the list of (repo, status).
+        """
+
+        self.update_repos()
+        if self.inotify is not None:
+            self.read_events()
+
+        fps = dict((repo, repo_fingerprint(repo)) for repo in self.repos)
+        todo = [r for r in self.repos if self.needs_check(r, fps[r])]
+
+        # Changes made while checking mark the repo dirty again
+        self.dirty.difference_update(todo)
+        if todo:
+            results = self.pool.map(check_repo, todo)
+            for repo, status in zip(todo, results):
+                self.cache[repo] = (fps[repo], status)
+
+        return [(repo, self.cache[repo][1]) for repo in self.repos]
+
+ENGINE = None
+
+def get_git_status():
+    """
+    Get git status.
+    """
+
+    global ENGINE
+
+    if ENGINE is None:
+        ENGINE = GitStatusEngine()
+
+    try:
+        statuses = ENGINE.statuses()
+    except (OSError, IOError):
+        log.warn("Failed to get git status", exc_info=True)
+        statuses = None
+
+    if statuses is None:
         return [{
             "name": MODULE,
             "instance": MODULE,
             "full_text": "??",
             "color": C_RED
         }]
-    else:
-        return [{
-            "name": MODULE,
-            "instance": MODULE,
-            "full_text": status,
-            "color": C_WHITE
-        }]
 
-def blocks_iter():
-    while True:
-        yield get_git_status()
-        time.sleep(2)
+    status = [fmt_status(repo, st) for repo, st in statuses]
+    status = [s for s in status if s is not None]
+    color = C_RED if any(st is None for _, st in statuses) else C_WHITE
+
+    return [{
+        "name": MODULE,
+        "instance": MODULE,
+        "full_text": " ".join(status),
+        "color": color
+    }]
+
+get_blocks = get_git_status
 
 def main():
-    do_main(MODULE, 15, blocks_iter())
+    do_main(MODULE, PRIO, periodic_iter(PERIOD, get_blocks))
 
 if __name__ == '__main__':
     main()
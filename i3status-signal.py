@@ -9,7 +9,6 @@ from __future__ import division, print_function
 
 __author__ = "Parantapa Bhattachara <pb [at] parantapa [dot] net>"
 
-import os
 import sys
 import signal
 from subprocess import Popen, PIPE
@@ -17,7 +16,7 @@ from subprocess import Popen, PIPE
 import logbook
 
 from i3status import get_pids
-from pbapps_common import get_i3status_rundir, get_logdir
+from pbapps_common import get_i3status_rundir, get_logdir, signal_service
 
 log = logbook.Logger("i3status-signal")
 
@@ -72,7 +71,7 @@ def do_main(service, signame):
     signum = signame_signum[signame]
 
     log.info("Sending signal {} to pid {} ...", signum, pid)
-    os.kill(pid, signum)
+    signal_service(extdir, service, pid, signum)
 
 def main():
     # Setup logfile
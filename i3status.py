@@ -13,7 +13,10 @@ import sys
 import json
 import glob
 import time
+import errno
 import codecs
+import socket
+import argparse
 from select import select, error as SelectError
 import signal
 
@@ -23,29 +26,111 @@ from pypb import register_exit_signals
 from pbapps_common import get_i3status_rundir, \
                           get_rundir, \
                           get_logdir, \
-                          dummy_handler
+                          get_i3status_sockname, \
+                          MAX_BLOCK_MESSAGE, send_click, \
+                          Inotify, IN_CLOSE_WRITE, IN_MOVED_TO, IN_DELETE
 
 log = logbook.Logger("i3status")
 
-def read():
+# Refresh period when nothing changes; catches producers that died
+POLL_PERIOD = 5.0
+
+# Time to wait for more block updates before rendering
+DEBOUNCE = 0.05
+
+# Period for logging the wakeup statistics
+STATS_PERIOD = 600
+
+# pypb.awriter renames the temp file in place; pid files are written directly
+WATCH_MASK = IN_MOVED_TO | IN_CLOSE_WRITE | IN_DELETE
+
+class WakeupStats(object):
     """
-    Read a single JSON encoded line.
+    Count the wakeups received and the status lines rendered.
+    """
+
+    def __init__(self):
+        self.wakeups = 0
+        self.renders = 0
+        self.last_log = time.time()
+
+    def wakeup_handler(self, signum, frame): # pylint: disable=unused-argument
+        """
+        Count the SIGUSR1 wakeups.
+        """
+
+        self.wakeups += 1
+
+    def maybe_log(self):
+        """
+        Log the counts every STATS_PERIOD seconds.
+        """
+
+        now = time.time()
+        if now - self.last_log < STATS_PERIOD:
+            return
+        self.last_log = now
+
+        log.info("wakeups={} renders={}", self.wakeups, self.renders)
+
+STATS = WakeupStats()
+
+def wait_readable(fobjs, timeout):
+    """
+    Wait for any of the fobjs to become readable.
+
+    Returns None if interrupted by a signal.
     """
 
     try:
-        rl, _, _ = select([sys.stdin], [], [], 1.0)
-        if not rl:
-            return None
+        rl, _, _ = select(fobjs, [], [], timeout)
     except SelectError:
         return None
+    return rl
 
-    inp = raw_input().strip()
-    if inp == '[':
-        return None
+class ClickReader(object):
+    """
+    Non-blocking reader of the click events i3bar writes to stdin.
+
+    i3bar sends an endless JSON array with one event per line:
+
+    [
+    {"name": "volume", "instance": "pulseaudio", "button": 1, ...}
+    ,{"name": "volume", "instance": "pulseaudio", "button": 4, ...}
+    """
 
-    inp = inp.strip(",")
-    inp = json.loads(inp)
-    return inp
+    def __init__(self, fobj):
+        self.fd = fobj.fileno()
+        self.buf = b""
+        self.closed = False
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        """
+        Get the complete events read so far; call when readable.
+        """
+
+        data = os.read(self.fd, 65536)
+        if not data:
+            log.info("stdin closed; ignoring clicks from now on")
+            self.closed = True
+            return []
+
+        lines = (self.buf + data).split(b"\n")
+        self.buf = lines.pop()
+
+        events = []
+        for line in lines:
+            line = line.strip().lstrip(b"[,").strip()
+            if not line:
+                continue
+            try:
+                events.append(json.loads(line.decode("utf-8")))
+            except ValueError:
+                log.warn("Invalid click event: {!r}", line)
+        return events
 
 def write(obj, hdr=False):
     """
@@ -63,71 +148,182 @@ def write(obj, hdr=False):
         sys.stdout.flush()
         return
 
-    print("," + json.dumps(obj))
+    write_line(json.dumps(obj))
+
+def write_line(line):
+    """
+    Write an already JSON encoded status line.
+    """
+
+    print("," + line)
     sys.stdout.flush()
 
-def get_pids(extdir):
+def read_pid(fname):
+    """
+    Read the pid from a .pid file.
+
+    Returns None if the file is invalid.
+    """
+
+    try:
+        with open(fname, "r") as fobj:
+            pid = fobj.read().strip()
+        return int(pid)
+    except (OSError, IOError, ValueError):
+        return None
+
+def read_block(fname):
+    """
+    Read the list of blocks from a .block file.
+
+    Returns None if the file is invalid.
+    """
+
+    try:
+        # Get the json state
+        with open(fname) as fobj:
+            block = json.load(fobj)
+    except (OSError, IOError, ValueError):
+        return None
+
+    return normalize_block(block)
+
+def normalize_block(block):
+    """
+    Make sure the block state is a list of blocks.
+
+    Returns None if the block state is invalid.
+    """
+
+    if isinstance(block, list):
+        return block
+    elif isinstance(block, dict):
+        return [block]
+    else:
+        return None
+
+def file_key(fname):
+    """
+    Return the key identifying the current version of a file.
+
+    Block files are atomically replaced by rename, so the inode changes
+    on every update; mtime and size catch in place writes.
+    """
+
+    st = os.stat(fname)
+    mtime = getattr(st, "st_mtime_ns", st.st_mtime)
+    return (st.st_ino, mtime, st.st_size)
+
+class FileCache(object):
+    """
+    Cache of parsed files keyed on (inode, mtime, size).
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.entries = {}
+
+        # Incremented whenever a cached value changes
+        self.generation = 0
+
+    def get(self, fname):
+        """
+        Get the parsed value of fname, re-reading only if it changed.
+        """
+
+        try:
+            key = file_key(fname)
+        except OSError:
+            self.discard(fname)
+            return None
+
+        entry = self.entries.get(fname)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+
+        value = self.loader(fname)
+        self.entries[fname] = (key, value)
+        self.generation += 1
+        return value
+
+    def discard(self, fname):
+        """
+        Drop fname from the cache.
+        """
+
+        if self.entries.pop(fname, None) is not None:
+            self.generation += 1
+
+    def prune(self, fnames):
+        """
+        Drop everything except fnames from the cache.
+        """
+
+        for fname in set(self.entries).difference(fnames):
+            self.discard(fname)
+
+def get_service(fname):
+    """
+    Get the service name from a .pid or .block file name.
+    """
+
+    service = os.path.basename(fname)
+    return service.split(".")[0]
+
+def get_pids(extdir, cache=None):
     """
     Get the dict of service to process ids.
     """
 
+    if cache is None:
+        cache = FileCache(read_pid)
+
     pid_fnames = glob.glob(extdir + "/*.pid")
+    cache.prune(pid_fnames)
 
     pids = {}
     for fname in pid_fnames:
-        try:
-            # Get the pid
-            with open(fname, "r") as fobj:
-                pid = fobj.read().strip()
-            pid = int(pid)
+        pid = cache.get(fname)
+        if pid is None:
+            continue
 
+        try:
             # Check if process running
             os.kill(pid, 0)
-        except (OSError, IOError, ValueError):
+        except OSError:
             continue
 
-        service = os.path.basename(fname)
-        service = service.split(".")[0]
-        pids[service] = pid
+        pids[get_service(fname)] = pid
 
     return pids
 
-def get_blocks(extdir):
+def get_blocks(extdir, cache=None):
     """
     Get the i3bar blocks.
     """
 
+    if cache is None:
+        cache = FileCache(read_block)
+
     block_fnames = glob.glob(extdir + "/*.block")
+    cache.prune(block_fnames)
 
     blocks = {}
     for fname in block_fnames:
-        try:
-            # Get the json state
-            with open(fname) as fobj:
-                block = json.load(fobj)
-        except (OSError, IOError, ValueError):
-            continue
-
-        if isinstance(block, list):
-            pass
-        elif isinstance(block, dict):
-            block = [block]
-        else:
+        block = cache.get(fname)
+        if block is None:
             continue
 
-        service = os.path.basename(fname)
-        service = service.split(".")[0]
-        blocks[service] = block
+        blocks[get_service(fname)] = block
 
     return blocks
 
-def read_blocks(extdir):
-    """
-    Read all the state and pid files.
+def merge_blocks(pids, blocks, owners=None):
     """
+    Merge the blocks of the running services in order.
 
-    pids = get_pids(extdir)
-    blocks = get_blocks(extdir)
+    If given, owners is filled with (name, instance) -> service.
+    """
 
     services = sorted(pids)
     ret = []
@@ -145,9 +341,313 @@ def read_blocks(extdir):
             blk.setdefault("full_text", "running")
             ret.append(blk)
 
+            if owners is not None:
+                owners[block_id(blk)] = service
+
     return ret
 
+def block_id(block):
+    """
+    Get the (name, instance) of a block or click event.
+
+    i3bar may send the instance back as a string.
+    """
+
+    return block.get("name"), "%s" % block.get("instance")
+
+class BlockCache(object):
+    """
+    Incrementally maintained view of the .pid and .block files.
+    """
+
+    def __init__(self, extdir):
+        self.extdir = extdir
+        self.pid_files = FileCache(read_pid)
+        self.block_files = FileCache(read_block)
+
+        # service -> (blocks, key of the .block file when pushed)
+        self.pushed = {}
+        self.n_pushes = 0
+
+        self._key = None
+        self._blocks = None
+        self._line = None
+
+        # (name, instance) -> service, and service -> pid
+        self.owners = {}
+        self.pids = {}
+
+    def read_blocks(self):
+        """
+        Get the merged blocks; rebuilt only if something changed.
+        """
+
+        pids = get_pids(self.extdir, self.pid_files)
+        blocks = get_blocks(self.extdir, self.block_files)
+
+        # Pushed blocks are valid until the .block file is replaced
+        for service, (blks, key) in list(self.pushed.items()):
+            if self._file_key(service) != key:
+                del self.pushed[service]
+                continue
+            blocks[service] = blks
+
+        key = (self.pid_files.generation,
+               self.block_files.generation,
+               self.n_pushes,
+               tuple(sorted(pids)))
+        if key != self._key:
+            self._key = key
+            self.owners = {}
+            self.pids = pids
+            self._blocks = merge_blocks(pids, blocks, self.owners)
+            self._line = None
+
+        return self._blocks
+
+    def _file_key(self, service):
+        """
+        Get the cached key of the service's .block file.
+        """
+
+        fname = "%s/%s.block" % (self.extdir, service)
+        entry = self.block_files.entries.get(fname)
+        return None if entry is None else entry[0]
+
+    def push(self, service, blocks):
+        """
+        Set the blocks of service received over the socket.
+        """
+
+        # Bring the cache up to date so that an older file
+        # doesn't override the pushed blocks later
+        self.block_files.get("%s/%s.block" % (self.extdir, service))
+
+        self.pushed[service] = (blocks, self._file_key(service))
+        self.n_pushes += 1
+
+    def owner(self, event):
+        """
+        Get the (service, pid) owning the block clicked on; None if gone.
+        """
+
+        service = self.owners.get(block_id(event))
+        if service is None or service not in self.pids:
+            return None
+        return service, self.pids[service]
+
+    def status_line(self):
+        """
+        Get the JSON encoded status line.
+
+        The line is only re-encoded if something changed.
+        """
+
+        self.read_blocks()
+        if self._line is None:
+            self._line = json.dumps(self._blocks)
+        return self._line
+
+def read_blocks(extdir, cache=None):
+    """
+    Read all the state and pid files.
+    """
+
+    if cache is None:
+        cache = BlockCache(extdir)
+    return cache.read_blocks()
+
+def open_socket(sockname):
+    """
+    Open the socket on which producers push blocks.
+    """
+
+    try:
+        os.remove(sockname)
+    except OSError:
+        pass
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(sockname)
+    sock.setblocking(False)
+    return sock
+
+def read_socket(sock, cache):
+    """
+    Apply all the pending block messages to the cache.
+
+    Returns the number of messages applied.
+    """
+
+    count = 0
+    while True:
+        try:
+            data = sock.recv(MAX_BLOCK_MESSAGE)
+        except socket.error as e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                break
+            raise
+
+        try:
+            msg = json.loads(data.decode("utf-8"))
+            service = msg["service"]
+            blocks = normalize_block(msg["blocks"])
+        except (ValueError, KeyError, TypeError):
+            log.warn("Invalid block message: {!r}", data)
+            continue
+        if blocks is None:
+            continue
+
+        cache.push(service, blocks)
+        count += 1
+
+    return count
+
+def is_block_event(event):
+    """
+    Check if the inotify event is about a .pid or .block file.
+    """
+
+    name = event[3]
+    return name.endswith(".block") or name.endswith(".pid")
+
+def render(cache, last_line):
+    """
+    Write out the status line if it changed since last_line.
+
+    Returns the current status line.
+    """
+
+    line = cache.status_line()
+    if line != last_line:
+        write_line(line)
+        STATS.renders += 1
+    STATS.maybe_log()
+    return line
+
+def dispatch_clicks(clicks, cache):
+    """
+    Pass the pending click events to the services owning the blocks.
+    """
+
+    for event in clicks.read():
+        owner = cache.owner(event)
+        if owner is None:
+            log.info("Nobody owns the clicked block {}", block_id(event))
+            continue
+
+        service, pid = owner
+        try:
+            if not send_click(cache.extdir, service, pid, event):
+                log.info("{} doesn't take clicks", service)
+        except (OSError, IOError):
+            log.warn("Can't pass click to {}", service, exc_info=True)
+
+def debounce_sleep(debounce):
+    """
+    Sleep for the debounce window, even if interrupted by wakeups.
+    """
+
+    end = time.time() + debounce
+    now = time.time()
+    while now < end:
+        time.sleep(end - now)
+        now = time.time()
+
+def run_poll(extdir, sock, clicks):
+    """
+    Re-read all the blocks at a fixed period.
+    """
+
+    cache = BlockCache(extdir)
+    line = None
+    while True:
+        if sock is not None:
+            STATS.wakeups += read_socket(sock, cache)
+        line = render(cache, line)
+
+        # Clicks are passed on as they come
+        end = time.time() + POLL_PERIOD
+        now = time.time()
+        while now < end:
+            if clicks.closed:
+                time.sleep(end - now)
+            elif wait_readable([clicks], end - now):
+                dispatch_clicks(clicks, cache)
+            now = time.time()
+
+def read_events(inotify, sock, cache):
+    """
+    Process the pending inotify events and block messages.
+
+    Returns the number of wakeups they amount to.
+    """
+
+    wakeups = sum(1 for e in inotify.read() if is_block_event(e))
+    if sock is not None:
+        wakeups += read_socket(sock, cache)
+
+    STATS.wakeups += wakeups
+    return wakeups
+
+def run_inotify(extdir, sock, inotify, debounce, clicks):
+    """
+    Re-read the blocks only when a block file is replaced
+    or new blocks are pushed over the socket.
+    """
+
+    inotify.add_watch(extdir, WATCH_MASK)
+
+    fobjs = [clicks, inotify]
+    if sock is not None:
+        fobjs.append(sock)
+
+    cache = BlockCache(extdir)
+    line = render(cache, None)
+    while True:
+        rl = wait_readable(fobjs, POLL_PERIOD)
+
+        # Woken up by timeout
+        if rl is not None and not rl:
+            line = render(cache, line)
+            continue
+
+        # Woken up by signal or events
+        if rl is not None:
+            if clicks in rl:
+                # Clicks go out before the debounce
+                dispatch_clicks(clicks, cache)
+                if clicks.closed:
+                    fobjs.remove(clicks)
+            if not read_events(inotify, sock, cache):
+                continue
+
+        # Fold in the wakeups arriving within the debounce window
+        debounce_sleep(debounce)
+        read_events(inotify, sock, cache)
+
+        line = render(cache, line)
+
+def parse_args():
+    """
+    Parse the command line arguments.
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--poll", action="store_true",
+                        help="poll the run directory instead of using inotify")
+    parser.add_argument("--no-socket", action="store_true",
+                        help="don't accept blocks pushed over the socket")
+    parser.add_argument("--debounce", type=float, default=DEBOUNCE,
+                        help="seconds to wait for more block updates "
+                             "before rendering (default: %(default)s)")
+    return parser.parse_args()
+
 def main():
+    args = parse_args()
+
     # Setup logfile
     logfile = get_logdir() + "/i3status.log"
     logbook.FileHandler(logfile).push_application()
@@ -161,24 +661,37 @@ def main():
         # Get the external state directory
         extdir = get_i3status_rundir()
 
-        # Make stdin and stdout UTF-8
+        # Make stdout UTF-8; click events are read from the raw stdin
         sys.stdout = codecs.getwriter("utf-8")(sys.stdout)
-        sys.stdin = codecs.getreader("utf-8")(sys.stdin)
+        clicks = ClickReader(sys.stdin)
 
-        # Setup dummy signal handler on SIGUSR1
+        # Count wakeups on SIGUSR1
         # Useful for waking up from sleep
         register_exit_signals()
-        signal.signal(signal.SIGUSR1, dummy_handler)
+        signal.signal(signal.SIGUSR1, STATS.wakeup_handler)
 
         # Write out the header
         write({"version": 1, "click_events": True}, True)
         write(None)
 
-        while True:
-            # We ignore the input
-            _ = read()
-            write(read_blocks(extdir))
-            time.sleep(5)
+        # Producers fall back to the .block files if we don't listen
+        sock = None
+        if not args.no_socket:
+            sock = open_socket(get_i3status_sockname())
+
+        if args.poll:
+            run_poll(extdir, sock, clicks)
+            return
+
+        try:
+            inotify = Inotify()
+        except OSError:
+            log.warn("inotify not available; falling back to polling",
+                     exc_info=True)
+            run_poll(extdir, sock, clicks)
+            return
+
+        run_inotify(extdir, sock, inotify, args.debounce, clicks)
 
 if __name__ == '__main__':
     main()
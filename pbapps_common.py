@@ -6,7 +6,19 @@ Common code required by most app scripts.
 import os
 from os.path import join, dirname, abspath
 import json
+import time
+import math
+import heapq
+import fcntl
+import errno
+import itertools
+import socket
+import struct
 import signal
+import threading
+import ctypes
+import ctypes.util
+from select import select, error as SelectError
 from subprocess import Popen, PIPE
 
 import logbook
@@ -38,6 +50,9 @@ ICONS = AttrDict({
     "fa_warn": u"\uf071",
     "fa_memory": u"\uf1c0",
     "fa_cpu": u"\uf108",
+    "fa_exchange": u"\uf0ec",
+    "fa_tachometer": u"\uf0e4",
+    "fa_thermometer": u"\uf2c9",
 })
 
 COLORS = AttrDict({
@@ -62,6 +77,11 @@ def _get_system_dir(fmt):
     uid = int(uid)
     sysdir = fmt.format(uid)
 
+    # Relocate all the directories, e.g. for benchmarks
+    root = os.environ.get("PBAPPS_ROOT")
+    if root:
+        sysdir = root + sysdir
+
     if not os.path.exists(sysdir):
         try:
             os.makedirs(sysdir, 0o700)
@@ -84,6 +104,13 @@ def get_rundir():
 
     return _get_system_dir("/run/user/{}/pbapps/run")
 
+def get_i3status_sockname():
+    """
+    Get the socket on which i3status receives blocks.
+    """
+
+    return get_rundir() + "/i3status.sock"
+
 def get_logdir():
     """
     Get the directory for log files.
@@ -91,22 +118,218 @@ def get_logdir():
 
     return _get_system_dir("/var/tmp/pbapps/log")
 
-def wake_i3status():
+def get_datadir():
     """
-    Wake up the i3status program.
+    Get the directory for data kept across reboots.
+    """
+
+    return _get_system_dir("/var/tmp/pbapps/data")
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_INOTIFY_EVENT = struct.Struct("iIII")
+
+class Inotify(object):
+    """
+    Minimal inotify(7) wrapper using ctypes.
+
+    The object has a fileno() so that it can be passed to select().
+    """
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._libc = libc
+
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.fd = fd
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        """
+        Add a watch on path; returns the watch descriptor.
+        """
+
+        if not isinstance(path, bytes):
+            path = path.encode("utf-8")
+
+        wd = self._libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def rm_watch(self, wd):
+        """
+        Remove a watch.
+        """
+
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self):
+        """
+        Read all pending events without blocking.
+
+        Returns list of (wd, mask, cookie, name) tuples.
+        """
+
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    break
+                raise
+            if not data:
+                break
+
+            pos = 0
+            while pos < len(data):
+                wd, mask, cookie, size = _INOTIFY_EVENT.unpack_from(data, pos)
+                pos += _INOTIFY_EVENT.size
+                name = data[pos:pos + size].rstrip(b"\0").decode("utf-8")
+                pos += size
+                events.append((wd, mask, cookie, name))
+
+        return events
+
+    def close(self):
+        """
+        Close the inotify file descriptor.
+        """
+
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+# Cached pid of i3status; re-read from the pidfile only when it is gone
+I3STATUS_PID = None
+
+def read_i3status_pid():
+    """
+    Read i3status' pid from its pidfile.
+
+    Returns None if the pidfile is missing or invalid.
     """
 
     pidfile = get_rundir() + "/i3status.pid"
     try:
-        # Get the pid
         with open(pidfile, "r") as fobj:
             pid = fobj.read().strip()
-        pid = int(pid)
-
-        # Send SIGUSR1
-        os.kill(pid, signal.SIGUSR1)
+        return int(pid)
     except (OSError, IOError, ValueError):
-        pass
+        return None
+
+def wake_i3status():
+    """
+    Wake up the i3status program.
+    """
+
+    global I3STATUS_PID
+
+    if I3STATUS_PID is None:
+        I3STATUS_PID = read_i3status_pid()
+
+    while I3STATUS_PID is not None:
+        try:
+            # Send SIGUSR1
+            os.kill(I3STATUS_PID, signal.SIGUSR1)
+            return
+        except OSError as e:
+            # EPERM: the pid now belongs to another user's process
+            if e.errno not in (errno.ESRCH, errno.EPERM):
+                return
+
+        # i3status is gone; maybe it was restarted
+        pid = read_i3status_pid()
+        if pid == I3STATUS_PID:
+            pid = None
+        I3STATUS_PID = pid
+
+# Largest block message sent over the i3status socket
+MAX_BLOCK_MESSAGE = 65536
+
+# When pushing over the socket write the .block file at least this often,
+# so that a restarted i3status can recover the state.
+BLOCK_FILE_SYNC_PERIOD = 60
+
+class BlockPublisher(object):
+    """
+    Publish the blocks of a service to i3status.
+
+    Blocks are pushed as a single datagram to i3status' socket. The .block
+    file is written instead if i3status is not listening on the socket.
+    """
+
+    def __init__(self, extdir, prio, modname):
+        self.service = "%d%s" % (prio, modname)
+        self.blockfile = "%s/%s.block" % (extdir, self.service)
+        self.sockname = get_i3status_sockname()
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+
+        self.last_sync = None
+
+    def send(self, blocks):
+        """
+        Try to send blocks over the socket.
+
+        Returns True on success.
+        """
+
+        msg = {"service": self.service, "blocks": blocks}
+        msg = json.dumps(msg).encode("utf-8")
+        if len(msg) > MAX_BLOCK_MESSAGE:
+            return False
+
+        try:
+            self.sock.sendto(msg, self.sockname)
+        except socket.error:
+            return False
+        return True
+
+    def write(self, blocks):
+        """
+        Write blocks to the .block file.
+        """
+
+        with aw.open(self.blockfile, "w") as fobj:
+            json.dump(blocks, fobj)
+        self.last_sync = time.time()
+
+    def publish(self, blocks):
+        """
+        Publish the blocks.
+        """
+
+        if not self.send(blocks):
+            self.write(blocks)
+            wake_i3status()
+            return
+
+        if (self.last_sync is None
+                or time.time() - self.last_sync >= BLOCK_FILE_SYNC_PERIOD):
+            self.write(blocks)
 
 def parse_period(text):
     """
@@ -162,6 +385,264 @@ def fmt_period(period):
     else:
         return "{}s".format(ss)
 
+class Scheduler(object):
+    """
+    Schedule periodic tasks against absolute deadlines.
+
+    A task's next deadline is its last deadline plus its period, so the
+    time taken by the task doesn't make the schedule drift. Deadlines
+    that have been missed entirely are skipped.
+    """
+
+    # Deadlines this close in the future are considered due
+    SLACK = 0.001
+
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+
+    def add(self, task, period, align=False, start=None):
+        """
+        Add a task to run every period seconds.
+
+        If align is True deadlines fall on multiples of period.
+        """
+
+        if start is None:
+            start = time.time()
+        if align:
+            start = math.ceil(start / period) * period
+
+        entry = (start, next(self.counter), task, period)
+        heapq.heappush(self.heap, entry)
+
+    def wait_time(self, now=None):
+        """
+        Get the time until the next deadline.
+        """
+
+        if not self.heap:
+            return None
+        if now is None:
+            now = time.time()
+        return max(0.0, self.heap[0][0] - now)
+
+    def pop_due(self, now=None):
+        """
+        Get the tasks that are due and schedule their next run.
+        """
+
+        if now is None:
+            now = time.time()
+
+        due = []
+        while self.heap and self.heap[0][0] <= now + self.SLACK:
+            deadline, _, task, period = heapq.heappop(self.heap)
+            due.append((deadline, task, period))
+
+        for deadline, task, period in due:
+            missed = math.floor((now - deadline) / period)
+            deadline += (max(0, missed) + 1) * period
+
+            entry = (deadline, next(self.counter), task, period)
+            heapq.heappush(self.heap, entry)
+
+        return [task for _, task, _ in due]
+
+class Wakeup(object):
+    """
+    A sleep that can be cut short.
+
+    set() only writes to a pipe, so it is safe to call from signal
+    handlers and other threads; fileno() can be passed to select().
+    """
+
+    def __init__(self):
+        self.rfd, self.wfd = os.pipe()
+        for fd in (self.rfd, self.wfd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def fileno(self):
+        return self.rfd
+
+    def set(self):
+        """
+        Wake up the sleeper.
+        """
+
+        try:
+            os.write(self.wfd, b"x")
+        except OSError:
+            # Pipe full; a wakeup is pending anyway
+            pass
+
+    def handler(self, signum, frame): # pylint: disable=unused-argument
+        """
+        Signal handler calling set().
+        """
+
+        self.set()
+
+    def clear(self):
+        """
+        Drop the pending wakeups.
+        """
+
+        try:
+            while os.read(self.rfd, 4096):
+                pass
+        except OSError:
+            pass
+
+    def sleep(self, secs=None):
+        """
+        Sleep for secs or until woken up, forever if secs is None.
+
+        A signal interrupting the sleep also wakes it up.
+        Returns True if woken up.
+        """
+
+        try:
+            rl, _, _ = select([self.rfd], [], [], secs)
+        except SelectError:
+            rl = True
+        self.clear()
+        return bool(rl)
+
+def periodic_iter(period, func, align=False, wake=None):
+    """
+    Yield the blocks returned by func every period seconds.
+
+    A signal interrupting the sleep (e.g. SIGUSR1 with dummy_handler)
+    or the Wakeup wake being set gets an immediate extra run.
+    """
+
+    sched = Scheduler()
+    sched.add(func, period, align)
+
+    while True:
+        tasks = sched.pop_due()
+        if not tasks:
+            # Woken up early
+            tasks = [func]
+
+        for task in tasks:
+            yield task()
+
+        if wake is not None:
+            wake.sleep(sched.wait_time())
+        else:
+            time.sleep(sched.wait_time())
+
+# Time given to a command to exit after SIGTERM before it is killed
+TERM_GRACE = 5
+
+# How often to check if a command that closed its stdout has exited
+EXIT_POLL = 0.05
+
+def _stop_processes(procs):
+    """
+    Terminate the processes, killing those that don't exit in time.
+    """
+
+    for proc in procs:
+        try:
+            proc.terminate()
+        except OSError:
+            pass
+
+    end = time.time() + TERM_GRACE
+    while any(p.poll() is None for p in procs) and time.time() < end:
+        time.sleep(0.1)
+
+    for proc in procs:
+        if proc.poll() is None:
+            try:
+                proc.kill()
+            except OSError:
+                pass
+        proc.wait()
+
+def run_commands(cmds, timeout=None, stderr=None):
+    """
+    Run the commands concurrently and collect their output.
+
+    cmds    - List of commands (argument lists)
+    timeout - Seconds to wait for the commands; a number or one per command
+    stderr  - Where to send the stderr of the commands
+
+    Returns a list of (returncode, stdout) tuples. Commands that failed to
+    start or were stopped because they took too long have returncode None.
+    A command is waited for till it exits, not just till its stdout is
+    closed.
+    """
+
+    if not isinstance(timeout, (list, tuple)):
+        timeout = [timeout] * len(cmds)
+
+    now = time.time()
+    results = [(None, b"")] * len(cmds)
+    running = []
+    for i, (cmd, tout) in enumerate(zip(cmds, timeout)):
+        try:
+            proc = Popen(cmd, stdout=PIPE, stderr=stderr, close_fds=True)
+        except OSError:
+            continue
+
+        deadline = None if tout is None else now + tout
+        running.append((i, proc, deadline, []))
+
+    while running:
+        now = time.time()
+
+        expired = [e for e in running
+                   if e[2] is not None and now >= e[2]]
+        if expired:
+            _stop_processes([e[1] for e in expired])
+            for i, proc, _, chunks in expired:
+                if not proc.stdout.closed:
+                    proc.stdout.close()
+                results[i] = (None, b"".join(chunks))
+            running = [e for e in running if e not in expired]
+
+        # Stdout closed; waiting for the exit
+        for entry in list(running):
+            i, proc, _, chunks = entry
+            if proc.stdout.closed and proc.poll() is not None:
+                results[i] = (proc.returncode, b"".join(chunks))
+                running.remove(entry)
+        if not running:
+            break
+
+        readers = dict((e[1].stdout.fileno(), e) for e in running
+                       if not e[1].stdout.closed)
+        waits = [e[2] - now for e in running if e[2] is not None]
+        if len(readers) < len(running):
+            waits.append(EXIT_POLL)
+        wait = max(0.0, min(waits)) if waits else None
+        try:
+            rl, _, _ = select(list(readers), [], [], wait)
+        except SelectError:
+            continue
+
+        for fd in rl:
+            _, proc, _, chunks = readers[fd]
+            data = os.read(fd, 65536)
+            if data:
+                chunks.append(data)
+            else:
+                proc.stdout.close()
+
+    return results
+
+def run_command(cmd, timeout=None, stderr=None):
+    """
+    Run a single command; see run_commands.
+    """
+
+    return run_commands([cmd], timeout, stderr)[0]
+
 def sound_ping():
     """
     Make pinging sound.
@@ -203,9 +684,113 @@ def dummy_handler(signum, frame): # pylint: disable=unused-argument
     Pass; do nothing
     """
 
-def do_main(modname, prio, iterable):
+# Signal telling a service that click events are queued for it. Only
+# services marked as taking clicks get it, as it kills the others.
+CLICK_SIGNAL = signal.SIGUSR2
+
+def write_service_pid(extdir, prio, modname, pid=None, clicks=False):
+    """
+    Write out the pid file of a service.
+
+    With clicks True the service is marked as taking click events; it
+    must handle CLICK_SIGNAL by then.
+    """
+
+    if pid is None:
+        pid = os.getpid()
+
+    clickable = "%s/%d%s.clickable" % (extdir, prio, modname)
+    if clicks:
+        open(clickable, "w").close()
+    elif os.path.exists(clickable):
+        os.remove(clickable)
+
+    pidfile = "%s/%d%s.pid" % (extdir, prio, modname)
+    with open(pidfile, "w") as fobj:
+        fobj.write(str(pid))
+
+def signal_service(extdir, service, pid, signum):
+    """
+    Send signal to the process running service.
+
+    Services run inside plugin-host share its pid; the service name is
+    left in a .signal file so that the host can dispatch the signal.
+    """
+
+    sigfile = "%s/%s.signal" % (extdir, service)
+    with aw.open(sigfile, "w") as fobj:
+        fobj.write(str(signum))
+
+    os.kill(pid, signum)
+
+def send_click(extdir, service, pid, event):
+    """
+    Queue an i3bar click event for service and wake it with CLICK_SIGNAL.
+
+    Returns False if the service doesn't take clicks.
+    """
+
+    if not os.path.exists("%s/%s.clickable" % (extdir, service)):
+        return False
+
+    # Appends this small are atomic, so events are never interleaved
+    clickfile = "%s/%s.click" % (extdir, service)
+    with open(clickfile, "a") as fobj:
+        fobj.write(json.dumps(event) + "\n")
+
+    os.kill(pid, CLICK_SIGNAL)
+    return True
+
+def take_clicks(extdir, service):
+    """
+    Get and remove the click events queued for service.
+    """
+
+    clickfile = "%s/%s.click" % (extdir, service)
+    takenfile = clickfile + ".taken"
+    try:
+        os.rename(clickfile, takenfile)
+    except OSError:
+        return []
+
+    with open(takenfile, "r") as fobj:
+        lines = fobj.readlines()
+    os.remove(takenfile)
+
+    events = []
+    for line in lines:
+        try:
+            events.append(json.loads(line))
+        except ValueError:
+            continue
+    return events
+
+def run_clicks(extdir, service, on_click, clicks, wake=None):
+    """
+    Pass the queued clicks to on_click whenever clicks is set.
+
+    Afterwards wake, if given, is set to refresh the blocks.
+    """
+
+    log = logbook.Logger(service)
+
+    while True:
+        clicks.sleep()
+        events = take_clicks(extdir, service)
+        for event in events:
+            with log.catch_exceptions():
+                on_click(event)
+        if events and wake is not None:
+            wake.set()
+
+def do_main(modname, prio, iterable, on_click=None, wake=None):
     """
     Run the main function.
+
+    If given, on_click is called in a thread of its own with the i3bar
+    click events on the blocks. They arrive with CLICK_SIGNAL, which
+    cuts short any sleep; wake, if given, is set again once they are
+    handled (e.g. the Wakeup passed to periodic_iter).
     """
 
     # Setup logfile
@@ -218,18 +803,29 @@ def do_main(modname, prio, iterable):
         # Get the external state directory
         extdir = get_i3status_rundir()
 
-        # Write out my own pid
-        pidfile = "%s/%d%s.pid" % (extdir, prio, modname)
-        with open(pidfile, "w") as fobj:
-            fobj.write(str(os.getpid()))
-
         register_exit_signals()
 
-        # File to write block info
-        blockfile = "%s/%d%s.block" % (extdir, prio, modname)
+        if on_click is not None:
+            # Drop clicks meant for an earlier instance
+            service = "%d%s" % (prio, modname)
+            take_clicks(extdir, service)
+
+            clicks = Wakeup()
+            thread = threading.Thread(target=run_clicks,
+                                      args=(extdir, service, on_click,
+                                            clicks, wake),
+                                      name="clicks")
+            thread.daemon = True
+            thread.start()
+
+            signal.signal(CLICK_SIGNAL, clicks.handler)
+
+        # Write out my own pid, once ready for clicks
+        write_service_pid(extdir, prio, modname,
+                          clicks=on_click is not None)
+
+        publisher = BlockPublisher(extdir, prio, modname)
 
         while True:
             for blocks in iterable:
-                with aw.open(blockfile, "w") as fobj:
-                    json.dump(blocks, fobj)
-                wake_i3status()
+                publisher.publish(blocks)
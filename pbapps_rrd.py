@@ -0,0 +1,194 @@
+# encoding: utf-8
+"""
+Round robin store of metrics in a memory mapped file.
+
+The file has a header (field names and archives) followed by one
+archive per resolution. An archive is a fixed number of fixed width
+records of (bucket start time, sample count, field averages); the slot
+of a record is given by its time, so updates are O(1) and the file
+never grows.
+"""
+
+from __future__ import division, print_function, unicode_literals
+
+import os
+import mmap
+import time
+import struct
+
+MAGIC = b"PBRRD002"
+
+# magic, number of fields, number of archives
+HEADER = struct.Struct("<8sII")
+
+# Field name, NUL padded
+FIELD = struct.Struct("<16s")
+
+# Seconds per record, number of records
+ARCHIVE = struct.Struct("<II")
+
+# Bucket start time, number of samples, then one average per field
+RECORD = "<II%df"
+
+# 1s for an hour, 1m for a day, 1h for a month
+ARCHIVES = ((1, 3600), (60, 1440), (3600, 720))
+
+class RRD(object):
+    """
+    A round robin metrics file.
+
+    With fields given the file is opened for update and (re)created if
+    its layout differs; without them it is opened read only.
+    """
+
+    def __init__(self, fname, fields=None, archives=ARCHIVES):
+        self.fname = fname
+        self.writable = fields is not None
+
+        if self.writable:
+            self.fields = tuple(fields)
+            self.archives = tuple(archives)
+            self.record = struct.Struct(RECORD % len(self.fields))
+            if self.read_header() != (self.fields, self.archives):
+                self.create()
+        else:
+            layout = self.read_header()
+            if layout is None:
+                raise ValueError("Not a metrics file: %s" % fname)
+            self.fields, self.archives = layout
+            self.record = struct.Struct(RECORD % len(self.fields))
+
+        self.offsets = []
+        offset = self.header_size()
+        for _, rows in self.archives:
+            self.offsets.append(offset)
+            offset += rows * self.record.size
+
+        flags = os.O_RDWR if self.writable else os.O_RDONLY
+        self.fd = os.open(fname, flags)
+        access = mmap.ACCESS_WRITE if self.writable else mmap.ACCESS_READ
+        self.mm = mmap.mmap(self.fd, offset, access=access)
+
+        # Per archive [bucket, count, sums] of the bucket being filled
+        self.accs = [[None, 0, [0.0] * len(self.fields)]
+                     for _ in self.archives]
+
+    def header_size(self):
+        """
+        Get the size of the header.
+        """
+
+        return (HEADER.size + len(self.fields) * FIELD.size
+                + len(self.archives) * ARCHIVE.size)
+
+    def read_header(self):
+        """
+        Get the (fields, archives) of the file; None if it has none.
+        """
+
+        try:
+            with open(self.fname, "rb") as fobj:
+                data = fobj.read(HEADER.size)
+                if len(data) < HEADER.size:
+                    return None
+                magic, nfields, narchives = HEADER.unpack(data)
+                if magic != MAGIC:
+                    return None
+
+                fields = []
+                for _ in range(nfields):
+                    name = FIELD.unpack(fobj.read(FIELD.size))[0]
+                    fields.append(name.rstrip(b"\0").decode("utf-8"))
+
+                archives = []
+                for _ in range(narchives):
+                    archives.append(ARCHIVE.unpack(fobj.read(ARCHIVE.size)))
+        except (IOError, struct.error):
+            return None
+
+        return tuple(fields), tuple(archives)
+
+    def create(self):
+        """
+        Create an empty file of the full size.
+        """
+
+        header = HEADER.pack(MAGIC, len(self.fields), len(self.archives))
+        for name in self.fields:
+            header += FIELD.pack(name.encode("utf-8"))
+        for step, rows in self.archives:
+            header += ARCHIVE.pack(step, rows)
+
+        nrecords = sum(rows for _, rows in self.archives)
+        size = len(header) + nrecords * self.record.size
+
+        tmpname = self.fname + ".tmp"
+        with open(tmpname, "wb") as fobj:
+            fobj.write(header)
+            fobj.truncate(size)
+        os.rename(tmpname, self.fname)
+
+    def update(self, values, now=None):
+        """
+        Add a sample of the fields' values.
+
+        Each archive's record holds the average of the samples in its
+        time bucket so far, including those recorded before a restart.
+        """
+
+        if now is None:
+            now = time.time()
+        now = int(now)
+
+        for i, (step, rows) in enumerate(self.archives):
+            acc = self.accs[i]
+            bucket = now - now % step
+            pos = self.offsets[i] + (bucket // step) % rows * self.record.size
+            if acc[0] != bucket:
+                # Carry on with the samples already in the bucket
+                rec = self.record.unpack_from(self.mm, pos)
+                count = rec[1] if rec[0] == bucket else 0
+                acc[0], acc[1] = bucket, count
+                sums = acc[2]
+                for j in range(len(sums)):
+                    sums[j] = rec[2 + j] * count if count else 0.0
+
+            acc[1] += 1
+            sums = acc[2]
+            for j, value in enumerate(values):
+                sums[j] += value
+
+            self.record.pack_into(self.mm, pos, bucket, acc[1],
+                                  *[s / acc[1] for s in sums])
+
+    def fetch(self, step, start, end=None):
+        """
+        Get the [(time, values)] of the archive with given step.
+
+        Buckets between start and end with no samples are skipped.
+        """
+
+        idx = [s for s, _ in self.archives].index(step)
+        rows = self.archives[idx][1]
+        offset = self.offsets[idx]
+
+        if end is None:
+            end = time.time()
+        end = int(end)
+        start = max(int(start), end - (rows - 1) * step, 1)
+
+        out = []
+        for bucket in range(start - start % step, end + 1, step):
+            pos = offset + (bucket // step) % rows * self.record.size
+            rec = self.record.unpack_from(self.mm, pos)
+            if rec[0] == bucket:
+                out.append((bucket, rec[2:]))
+        return out
+
+    def close(self):
+        """
+        Unmap and close the file.
+        """
+
+        self.mm.close()
+        os.close(self.fd)
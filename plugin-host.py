@@ -0,0 +1,412 @@
+#!/usr/bin/env python2
+# encoding: utf-8
+"""
+Run several i3status block producers in a single process.
+
+Usage: ./plugin-host.py <plugin> [<plugin> ...]
+
+A plugin is one of the block producer scripts (e.g. sys-state).
+Plugins defining blocks_iter() (e.g. event driven ones) have it driven in
+a thread of their own; plugins defining only PERIOD and get_blocks() are
+run on a shared scheduler. SIGUSR1 reaches event driven plugins through
+the Wakeup named WAKE they sleep on, if they have one. Click events for
+plugins defining on_click() arrive with CLICK_SIGNAL.
+"""
+
+from __future__ import division, print_function, unicode_literals
+
+__author__ = "Parantapa Bhattachara <pb [at] parantapa [dot] net>"
+
+import os
+import sys
+import imp
+import time
+import signal
+import threading
+from os.path import join, dirname, abspath, exists
+from select import select, error as SelectError
+from Queue import Queue
+
+import logbook
+from pypb import register_exit_signals
+
+from pbapps_common import get_i3status_rundir, get_logdir, \
+                          write_service_pid, take_clicks, BlockPublisher, \
+                          Scheduler, COLORS, CLICK_SIGNAL
+
+MODULE = "plugin-host"
+
+SRCDIR = dirname(abspath(__file__))
+
+# Time a plugin gets to compute its blocks unless it sets TIMEOUT
+DEFAULT_TIMEOUT = 10
+
+log = logbook.Logger(MODULE)
+
+def load_plugin(name):
+    """
+    Import the plugin script.
+    """
+
+    fname = join(SRCDIR, name + ".py")
+    return imp.load_source(name.replace("-", "_"), fname)
+
+class Plugin(object):
+    """
+    A hosted block producer.
+    """
+
+    def __init__(self, name, extdir, wake_fd):
+        self.mod = load_plugin(name)
+        self.modname = self.mod.MODULE
+        self.prio = self.mod.PRIO
+        self.service = "%d%s" % (self.prio, self.modname)
+
+        self.period = getattr(self.mod, "PERIOD", None)
+        self.align = getattr(self.mod, "ALIGN", False)
+        self.timeout = getattr(self.mod, "TIMEOUT", DEFAULT_TIMEOUT)
+
+        self.extdir = extdir
+        self.wake_fd = wake_fd
+        self.publisher = BlockPublisher(extdir, self.prio, self.modname)
+
+        self.jobs = Queue()
+
+        # Guards the job state below and publishing
+        self.lock = threading.Lock()
+
+        # Jobs submitted and not yet done
+        self.pending = 0
+        self.busy_since = None
+        self.timed = True
+        self.warned = False
+        self.last_blocks = None
+
+    def is_periodic(self):
+        """
+        Check if the plugin is run by the scheduler.
+        """
+
+        if hasattr(self.mod, "blocks_iter"):
+            return False
+        return self.period is not None and hasattr(self.mod, "get_blocks")
+
+    def start(self):
+        """
+        Start the plugin's thread.
+        """
+
+        if self.is_periodic():
+            target = self.run_jobs
+        else:
+            target = self.run_iter
+
+        thread = threading.Thread(target=target, name=self.modname)
+        thread.daemon = True
+        thread.start()
+
+    def publish(self, blocks):
+        """
+        Publish the blocks.
+        """
+
+        with self.lock:
+            self.last_blocks = blocks
+            self.publisher.publish(blocks)
+
+    def run_iter(self):
+        """
+        Publish the blocks yielded by the plugin's blocks_iter().
+        """
+
+        with log.catch_exceptions():
+            while True:
+                for blocks in self.mod.blocks_iter():
+                    self.publish(blocks)
+
+    def run(self, func):
+        """
+        Call func, logging its failure.
+        """
+
+        try:
+            func()
+        except Exception: # pylint: disable=broad-except
+            log.error("Plugin {} failed", self.modname, exc_info=True)
+
+    def run_jobs(self):
+        """
+        Run the jobs submitted by the scheduler.
+
+        The blocks are refreshed after the last of the queued jobs only.
+        """
+
+        while True:
+            action = self.jobs.get()
+            if action is not None:
+                self.run(action)
+
+            with self.lock:
+                last = (self.pending == 1)
+            if last:
+                self.run(self.refresh)
+
+            with self.lock:
+                self.pending -= 1
+                if self.pending == 0:
+                    self.busy_since = None
+                    # Replace a warning shown while we were stuck
+                    if self.warned and self.last_blocks is not None:
+                        self.publisher.publish(self.last_blocks)
+                    self.warned = False
+            os.write(self.wake_fd, b"x")
+
+    def submit(self, action=None, timed=True):
+        """
+        Submit a job to the plugin's thread: run action, if any, then
+        refresh the blocks.
+
+        The timeout runs from the first of the queued jobs. Untimed jobs
+        (e.g. ones showing a dialog) are not reported as stuck.
+        """
+
+        with self.lock:
+            if self.pending == 0:
+                self.busy_since = time.time()
+                self.timed = timed
+            else:
+                self.timed = self.timed and timed
+            self.pending += 1
+        self.jobs.put(action)
+
+    def is_busy(self):
+        """
+        Check if the plugin has jobs to do.
+        """
+
+        with self.lock:
+            return self.pending > 0
+
+    def refresh(self):
+        """
+        Compute and publish the blocks.
+        """
+
+        self.publish(self.mod.get_blocks())
+
+    def on_usr1(self):
+        """
+        Run the plugin's SIGUSR1 action, if it has one.
+        """
+
+        on_usr1 = getattr(self.mod, "on_usr1", None)
+        if on_usr1 is not None:
+            on_usr1()
+
+    def wake(self):
+        """
+        Cut short the sleep of an event driven plugin.
+        """
+
+        wake = getattr(self.mod, "WAKE", None)
+        if wake is not None:
+            wake.set()
+
+    def on_clicks(self, events):
+        """
+        Pass the click events to the plugin's on_click.
+
+        Event driven plugins publish the resulting change themselves.
+        """
+
+        for event in events:
+            self.mod.on_click(event)
+
+    def check_timeout(self, now):
+        """
+        Replace the blocks with a warning if the plugin is stuck.
+        """
+
+        with self.lock:
+            if self.busy_since is None or not self.timed or self.warned:
+                return
+            if now - self.busy_since < self.timeout:
+                return
+
+            log.warn("Plugin {} timed out after {}s", self.modname,
+                     self.timeout)
+            self.warned = True
+            self.publisher.publish([{
+                "name": self.modname,
+                "full_text": "%s: ??" % self.modname,
+                "color": COLORS.red
+            }])
+
+    def timeout_wait(self, now):
+        """
+        Get the time until the running job times out.
+        """
+
+        with self.lock:
+            if self.busy_since is None or not self.timed or self.warned:
+                return None
+            return max(0.0, self.busy_since + self.timeout - now)
+
+class PluginHost(object):
+    """
+    Schedule the hosted plugins.
+    """
+
+    def __init__(self, names, extdir):
+        self.extdir = extdir
+        self.wake_r, self.wake_w = os.pipe()
+        self.plugins = [Plugin(name, extdir, self.wake_w) for name in names]
+        self.got_usr1 = False
+        self.got_clicks = False
+
+    def usr1_handler(self, signum, frame): # pylint: disable=unused-argument
+        """
+        Note the signal; dispatched from the main loop.
+        """
+
+        self.got_usr1 = True
+        os.write(self.wake_w, b"x")
+
+    def dispatch_usr1(self):
+        """
+        Pass SIGUSR1 to the plugins it was meant for.
+
+        If no plugin was named in a .signal file refresh all of them.
+        """
+
+        self.got_usr1 = False
+
+        targets = []
+        for plugin in self.plugins:
+            sigfile = "%s/%s.signal" % (self.extdir, plugin.service)
+            if exists(sigfile):
+                os.remove(sigfile)
+                targets.append(plugin)
+        if not targets:
+            targets = self.plugins
+
+        for plugin in targets:
+            if not plugin.is_periodic():
+                plugin.wake()
+                continue
+            plugin.submit(plugin.on_usr1, timed=False)
+
+    def clicks_handler(self, signum, frame): # pylint: disable=unused-argument
+        """
+        Note the click events; dispatched from the main loop.
+        """
+
+        self.got_clicks = True
+        os.write(self.wake_w, b"x")
+
+    def collect_clicks(self):
+        """
+        Pass the queued click events to the plugins taking them.
+        """
+
+        self.got_clicks = False
+
+        for plugin in self.plugins:
+            if not hasattr(plugin.mod, "on_click"):
+                continue
+            events = take_clicks(self.extdir, plugin.service)
+            if events:
+                self.dispatch_clicks(plugin, events)
+
+    def dispatch_clicks(self, plugin, events): # pylint: disable=no-self-use
+        """
+        Handle the click events in the plugin's thread.
+
+        Event driven plugins are busy in blocks_iter(), so their clicks
+        get a thread of their own.
+        """
+
+        job = lambda: plugin.on_clicks(events)
+        if plugin.is_periodic():
+            plugin.submit(job)
+            return
+
+        def run():
+            with log.catch_exceptions():
+                job()
+
+        thread = threading.Thread(target=run, name=plugin.modname + "-click")
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        """
+        Run the plugins forever.
+        """
+
+        for plugin in self.plugins:
+            # Clear out signals and clicks meant for an earlier instance
+            sigfile = "%s/%s.signal" % (self.extdir, plugin.service)
+            if exists(sigfile):
+                os.remove(sigfile)
+            take_clicks(self.extdir, plugin.service)
+
+            write_service_pid(self.extdir, plugin.prio, plugin.modname,
+                              clicks=hasattr(plugin.mod, "on_click"))
+            plugin.start()
+
+        periodic = [p for p in self.plugins if p.is_periodic()]
+        sched = Scheduler()
+        for plugin in periodic:
+            sched.add(plugin, plugin.period, plugin.align)
+
+        while True:
+            if self.got_usr1:
+                self.dispatch_usr1()
+            if self.got_clicks:
+                self.collect_clicks()
+
+            now = time.time()
+            for plugin in sched.pop_due(now):
+                # Skip this run if the last one is still going
+                if not plugin.is_busy():
+                    plugin.submit()
+            for plugin in periodic:
+                plugin.check_timeout(now)
+
+            waits = [sched.wait_time(now)]
+            waits += [p.timeout_wait(now) for p in periodic]
+            waits = [w for w in waits if w is not None]
+            timeout = min(waits) if waits else None
+
+            try:
+                rl, _, _ = select([self.wake_r], [], [], timeout)
+            except SelectError:
+                continue
+            if rl:
+                os.read(self.wake_r, 4096)
+
+def main():
+    # Setup logfile
+    logfile = "%s/%s.log" % (get_logdir(), MODULE)
+    logbook.FileHandler(logfile).push_application()
+
+    with log.catch_exceptions():
+        names = sys.argv[1:]
+        if not names:
+            print("Usage: ./plugin-host.py <plugin> [<plugin> ...]")
+            sys.exit(1)
+
+        # Get the external state directory
+        extdir = get_i3status_rundir()
+
+        host = PluginHost(names, extdir)
+
+        register_exit_signals()
+        signal.signal(signal.SIGUSR1, host.usr1_handler)
+        signal.signal(CLICK_SIGNAL, host.clicks_handler)
+
+        host.run()
+
+if __name__ == '__main__':
+    main()
@@ -8,47 +8,189 @@ from __future__ import division, print_function, unicode_literals
 
 __author__ = "Parantapa Bhattachara <pb [at] parantapa [dot] net>"
 
-import time
+import os
 import signal
-import subprocess as sub
+from itertools import islice
+from select import select, error as SelectError
+from subprocess import Popen, PIPE
+from tempfile import TemporaryFile
 
-from pbapps_common import do_main, dummy_handler, ICONS, COLORS
+import logbook
+
+from pbapps_common import do_main, periodic_iter, run_command, run_commands, \
+                          Wakeup, ICONS, COLORS
 
 MODULE = "pulseaudio-state"
+PRIO = 95
+PERIOD = 5
 
-def get_sound_pulseaudio():
+# Time given to pactl/pacmd before the volume is shown as unknown
+CMD_TIMEOUT = 2
+
+# When pactl subscribe is not available poll for this long before retrying
+RESUBSCRIBE_PERIOD = 60
+
+# Subscription events after which the default sink is re-queried
+SINK_FACILITIES = ("sink", "server")
+
+# Volume change per scroll step
+VOLUME_STEP = "5%"
+
+# pactl arguments for the i3bar mouse buttons
+CLICK_ACTIONS = {
+    1: ["set-sink-mute", "@DEFAULT_SINK@", "toggle"],
+    4: ["set-sink-volume", "@DEFAULT_SINK@", "+" + VOLUME_STEP],
+    5: ["set-sink-volume", "@DEFAULT_SINK@", "-" + VOLUME_STEP],
+}
+
+log = logbook.Logger(MODULE)
+
+# Set on SIGUSR1 to refresh the blocks
+WAKE = Wakeup()
+
+# What pactl says when it doesn't know a command, e.g. get-sink-volume
+UNKNOWN_COMMAND_MSGS = ("No valid command specified", "Unknown command")
+
+# Set to False if pactl can't query the default sink directly
+HAVE_GET_SINK = True
+
+def parse_volume(line):
     """
-    Get sound from Pulseaudio.
+    Parse the volume percentage of the first channel.
+
+    volume: front-left: 32768 /  50% / -18.06 dB,   front-right: ...
     """
 
-    try:
-        sinks = sub.check_output(["pacmd", "list-sinks"])
-    except sub.CalledProcessError:
-        sinks = None
+    vol = line.split()[4].strip("%")
+    return int(vol)
 
-    if sinks is None:
-        return [{
-            "name": "volume",
-            "instance": "pulseaudio",
-            "full_text": "{}: ??%".format(ICONS.fa_volume_off),
-            "color": COLORS.red
-        }]
+def parse_list_sinks(text):
+    """
+    Parse the default sink's state from the output of pacmd list-sinks.
+
+    Returns (volume, mute) or None if there is no default sink.
+    """
 
-    sinks = sinks.strip()
+    sinks = text.strip()
     sinks = sinks.split("\n")
     sinks = [s.strip() for s in sinks]
 
     idx = [i for i, s in enumerate(sinks) if s.startswith("* index:")]
+    if not idx:
+        return None
     idx = idx[0]
     sinks = sinks[idx:idx + 15]
 
-    mute = [s for s in sinks if s.startswith("muted:")][0]
-    mute = mute.split()[1]
-    mute = (mute == "yes")
+    try:
+        mute = [s for s in sinks if s.startswith("muted:")][0]
+        mute = mute.split()[1]
+        mute = (mute == "yes")
+
+        vol = [s for s in sinks if s.startswith("volume:")][0]
+        vol = parse_volume(vol)
+    except (IndexError, ValueError):
+        return None
+
+    return vol, mute
+
+def parse_default_sink(volume_text, mute_text):
+    """
+    Parse the output of pactl get-sink-volume and get-sink-mute.
+
+    Volume: front-left: 32768 /  50% / -18.06 dB,   front-right: ...
+            balance 0.00
+    Mute: no
+
+    Returns (volume, mute) or None.
+    """
+
+    try:
+        vol = [s for s in volume_text.split("\n") if s.startswith("Volume:")]
+        vol = parse_volume(vol[0])
+
+        mute = mute_text.split()
+        if mute[0] != "Mute:":
+            return None
+        mute = (mute[1] == "yes")
+    except (IndexError, ValueError):
+        return None
+
+    return vol, mute
+
+def parse_event(line):
+    """
+    Parse a line of pactl subscribe output.
+
+    Event 'change' on sink #0
+
+    Returns (event type, facility) or None.
+    """
+
+    parts = line.split()
+    if len(parts) < 4 or parts[0] != "Event" or parts[2] != "on":
+        return None
+
+    return parts[1].strip("'"), parts[3]
+
+def is_unknown_command(text):
+    """
+    Check if pactl's output says that it doesn't know the command.
+    """
+
+    return any(msg in text for msg in UNKNOWN_COMMAND_MSGS)
+
+def query_default_sink():
+    """
+    Get the (volume, mute) state of the default sink.
+
+    Returns None if pulseaudio can't be queried.
+    """
+
+    global HAVE_GET_SINK
 
-    vol = [s for s in sinks if s.startswith("volume:")][0]
-    vol = vol.split()[4].strip("%")
-    vol = int(vol)
+    if HAVE_GET_SINK:
+        cmds = [["pactl", "get-sink-volume", "@DEFAULT_SINK@"],
+                ["pactl", "get-sink-mute", "@DEFAULT_SINK@"]]
+        # Kept apart from the output, which is parsed
+        with TemporaryFile() as errf:
+            results = run_commands(cmds, CMD_TIMEOUT, stderr=errf)
+            errf.seek(0)
+            err = errf.read().decode("utf-8", "replace")
+        (vret, vout), (mret, mout) = results
+        if err.strip():
+            log.warn("pactl said: {}", err.strip())
+
+        if vret == 0 and mret == 0:
+            state = parse_default_sink(vout.decode("utf-8"),
+                                       mout.decode("utf-8"))
+            if state is not None:
+                return state
+
+        # Older pactl; use pacmd from now on. Other failures (e.g. the
+        # server restarting) are retried the next time.
+        if vret and is_unknown_command(err):
+            log.info("pactl can't get the sink volume; using pacmd")
+            HAVE_GET_SINK = False
+
+    retcode, sinks = run_command(["pacmd", "list-sinks"], CMD_TIMEOUT)
+    if retcode != 0:
+        return None
+    return parse_list_sinks(sinks.decode("utf-8"))
+
+def get_sound_pulseaudio():
+    """
+    Get sound from Pulseaudio.
+    """
+
+    state = query_default_sink()
+    if state is None:
+        return [{
+            "name": "volume",
+            "instance": "pulseaudio",
+            "full_text": "{}: ??%".format(ICONS.fa_volume_off),
+            "color": COLORS.red
+        }]
+    vol, mute = state
 
     if mute or vol < 1:
         symb = ICONS.fa_volume_off
@@ -64,14 +206,92 @@ def get_sound_pulseaudio():
         "color": color
     }]
 
+get_blocks = get_sound_pulseaudio
+
+def on_click(event):
+    """
+    Toggle mute on click and change the volume on scroll.
+
+    pactl subscribe reports the change, which updates the block.
+    """
+
+    args = CLICK_ACTIONS.get(event.get("button"))
+    if args is None:
+        return
+
+    retcode, out = run_command(["pactl"] + args, CMD_TIMEOUT)
+    if retcode != 0:
+        log.warn("pactl {} failed with {}: {!r}", " ".join(args), retcode, out)
+
+def subscribe_iter(proc):
+    """
+    Yield the blocks whenever pactl subscribe reports a sink change.
+
+    Returns when pactl exits.
+    """
+
+    fd = proc.stdout.fileno()
+    buf = b""
+
+    yield get_blocks()
+    while True:
+        try:
+            rl, _, _ = select([fd, WAKE], [], [])
+        except SelectError:
+            # Woken up by SIGUSR1
+            WAKE.clear()
+            yield get_blocks()
+            continue
+
+        if WAKE in rl:
+            WAKE.clear()
+            yield get_blocks()
+            if fd not in rl:
+                continue
+
+        data = os.read(fd, 4096)
+        if not data:
+            return
+
+        lines = (buf + data).split(b"\n")
+        buf = lines.pop()
+
+        events = [parse_event(l.decode("utf-8")) for l in lines]
+        if any(e is not None and e[1] in SINK_FACILITIES for e in events):
+            yield get_blocks()
+
 def blocks_iter():
+    """
+    Yield the blocks whenever pulseaudio reports a change.
+
+    Falls back to polling while pactl subscribe is not available.
+    """
+
     while True:
-        yield get_sound_pulseaudio()
-        time.sleep(5)
+        try:
+            proc = Popen(["pactl", "subscribe"], stdout=PIPE, close_fds=True)
+        except OSError:
+            proc = None
+
+        if proc is not None:
+            try:
+                for blocks in subscribe_iter(proc):
+                    yield blocks
+            finally:
+                if proc.poll() is None:
+                    proc.terminate()
+                proc.wait()
+            log.warn("pactl subscribe exited with {}", proc.returncode)
+
+        log.info("Polling for {}s ...", RESUBSCRIBE_PERIOD)
+        polls = RESUBSCRIBE_PERIOD // PERIOD
+        polling = periodic_iter(PERIOD, get_blocks, wake=WAKE)
+        for blocks in islice(polling, polls):
+            yield blocks
 
 def main():
-    signal.signal(signal.SIGUSR1, dummy_handler)
-    do_main(MODULE, 95, blocks_iter())
+    signal.signal(signal.SIGUSR1, WAKE.handler)
+    do_main(MODULE, PRIO, blocks_iter(), on_click, WAKE)
 
 if __name__ == '__main__':
     main()
@@ -9,39 +9,156 @@ from __future__ import division, print_function, unicode_literals
 __author__ = "Parantapa Bhattachara <pb [at] parantapa [dot] net>"
 
 import os
-from os.path import join, isdir, isfile
+from os.path import join, dirname, isdir, isfile, basename, getmtime
 import sys
 import time
+import re
 import json
 import random
 import signal
+import shutil
+import struct
 import hashlib
-from ConfigParser import ConfigParser
-from subprocess import call, check_output, CalledProcessError
+import binascii
+import threading
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from subprocess import call
+from urlparse import urlparse
+from distutils.spawn import find_executable
 
 import yaml
 import logbook
 import requests
+from requests.adapters import HTTPAdapter
 
 from pypb import abspath
 import pypb.awriter as aw
 from pypb import register_exit_signals
 
 from pbapps_common import get_i3status_rundir, get_logdir, \
-                          dummy_handler, wake_i3status, \
+                          dummy_handler, wake_i3status, run_command, \
                           AttrDict, ICONS, COLORS
 
 MODULE = "reddit-bg"
 
-IMAGE_EXTS = "jpg JPG jpeg JPEG png PNG".split()
+# Lowercased extensions of the images we use
+IMAGE_EXTS = frozenset(["jpg", "jpeg", "png"])
+
+# Extension classify_url gives imgur albums
+ALBUM = "album"
+
+IMGUR_ALBUM_API = "https://api.imgur.com/3/album/{}/images"
+GFYCAT_POSTER = "https://thumbs.gfycat.com/{}-poster.jpg"
 
 SYMB_REDDIT = ICONS.fa_reddit
 SYMB_SLEEPING = ICONS.fa_bed
 SYMB_GET_IMG_LIST = ICONS.fa_refresh
 SYMB_DOWNLOAD_IMG = ICONS.fa_download
 
+# Largest image we are willing to download
+MAX_IMAGE_BYTES = 20 * 1024 * 1024
+
+# Size of the chunks the images are streamed in
+CHUNK_SIZE = 64 * 1024
+
+# Magic bytes at the start of PNG and JPEG files
+IMAGE_MAGICS = (b"\x89PNG\r\n\x1a\n", b"\xff\xd8\xff")
+
+IMAGE_CONTENT_TYPES = ("image/png", "image/jpeg", "image/jpg")
+
+# Bytes read from the start of an image to find its dimensions
+HEADER_BYTES = 64 * 1024
+
+# JPEG start of frame markers; C4, C8 and CC are not frames
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - set([0xC4, 0xC8, 0xCC])
+
+# Number of subreddit listings fetched at once
+LISTING_WORKERS = 4
+
+# Number of posts kept per subreddit and fetched per request
+LISTING_SIZE = 100
+PAGE_SIZE = 100
+
+# Hot listings get reordered; fetch them in full this often
+LISTING_REFRESH = 6 * 3600
+
+# Post fields kept in the listing cache
+POST_FIELDS = ("name", "url", "over_18")
+
+# Allowed relative difference between image and screen aspect ratios
+ASPECT_TOLERANCE = 0.25
+
+# Number of candidate images downloaded ahead of the one being checked
+PREFETCH = 3
+
+# Tries per image download and the backoff between them, in seconds
+DOWNLOAD_ATTEMPTS = 4
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 30.0
+
+# Consecutive failed downloads after which a host is skipped
+BREAKER_FAILURES = 3
+
+# Partial downloads not resumed for this long are removed
+PART_MAX_AGE = 86400
+
+# Time given to ImageMagick to scale an image
+CONVERT_TIMEOUT = 60
+
+# How often to check for a queued wallpaper while there is none
+QUEUE_POLL = 5
+
+# How often the producer retries filling a queue left short, e.g. offline
+FILL_RETRY = 300
+
+# Prefix of the wallpapers put in queue_dir; only these are cleaned up
+QUEUE_PREFIX = "queued-"
+
+HAVE_CONVERT = find_executable("convert") is not None
+
+NITROGEN_SCREENS = {
+    "fullscreen" : ":0.0",
+    "screen1"    : "xin_0",
+    "screen2"    : "xin_1"
+}
+
+NITROGEN_MODES = {
+    "scaled"   : 0,
+    "auto"     : 4,
+    "centered" : 2
+}
+
+FEH_MODES = {
+    "scaled"   : "--bg-scale",
+    "auto"     : "--bg-fill",
+    "centered" : "--bg-center"
+}
+
 log = logbook.Logger(MODULE)
 
+SESSION = None
+
+# imgur album API url -> (url, dims) of its image or None
+ALBUMS = {}
+
+def get_session():
+    """
+    Get the shared session; connections are kept alive and reused.
+    """
+
+    global SESSION
+
+    if SESSION is None:
+        SESSION = requests.Session()
+
+        maxsize = max(LISTING_WORKERS, PREFETCH)
+        adapter = HTTPAdapter(pool_connections=maxsize, pool_maxsize=maxsize)
+        SESSION.mount("http://", adapter)
+        SESSION.mount("https://", adapter)
+
+    return SESSION
+
 def _req_get(*args, **kwargs):
     """
     Do a requests.get in a try catch block to catch all exceptions;
@@ -50,7 +167,7 @@ def _req_get(*args, **kwargs):
     kwargs.setdefault("timeout", 60)
 
     try:
-        r = requests.get(*args, **kwargs)
+        r = get_session().get(*args, **kwargs)
         return r
     except Exception: # pylint: disable=broad-except
         log.warn("Received unknown exception", exc_info=True)
@@ -84,214 +201,1105 @@ def _getimg(post):
 
     return post["data"]["url"]
 
-def _transform_imgur(url):
+def _imgur_image(match):
     """
-    Transform imgur urls.
+    Direct link to the image of an imgur page.
     """
 
-    for ext in IMAGE_EXTS:
-        if url.endswith("." + ext):
-            return url
+    return True, "https://i.imgur.com/%s.jpg" % match.group(1), "jpg"
 
-    check = {
-        "http://imgur.com/a/": False,
-        "https://imgur.com/a/": False,
-        "http://imgur.com": True,
-        "https://imgur.com": True,
-    }
-    for prefix, code in check.items():
-        if url.startswith(prefix):
-            if code:
-                return url + ".jpg"
-            else:
-                return url
+def _imgur_album(match):
+    """
+    API url of an imgur album; see resolve_imgur_album.
+    """
 
-    return url
+    return False, IMGUR_ALBUM_API.format(match.group(1)), ALBUM
 
-def _is_image_url(url):
+def _gfycat_poster(match):
     """
-    Check if url is image url.
+    Still image of a gfycat animation.
     """
 
-    for ext in IMAGE_EXTS:
-        if url.endswith("." + ext):
-            return True
+    return True, GFYCAT_POSTER.format(match.group(1)), "jpg"
 
-    return False
+_IMGUR_RULES = [
+    (re.compile(r"^/(?:a|gallery)/(\w+)/?$"), _imgur_album),
+    (re.compile(r"^/(\w+)/?$"), _imgur_image),
+]
 
-def _getext(url):
+# host -> [(path regex, handler)]; tried when the path is not an image's
+HOST_RULES = {
+    "imgur.com": _IMGUR_RULES,
+    "m.imgur.com": _IMGUR_RULES,
+    "gfycat.com": [
+        (re.compile(r"^/(?:gifs/detail/)?([A-Za-z]+)/?$"), _gfycat_poster),
+    ],
+}
+
+def classify_url(url):
     """
-    From url get file extension.
+    Classify a posted url.
+
+    Returns (is_image, normalized url, extension). For imgur albums the
+    url is the album's API url and the extension is ALBUM.
     """
 
-    for ext in IMAGE_EXTS:
-        if url.endswith("." + ext):
-            return ext
+    parts = urlparse(url)
+    path = parts.path
 
-    return "jpg"
+    dot = path.rfind(".")
+    if dot > path.rfind("/"):
+        ext = path[dot + 1:]
+        if ext.lower() in IMAGE_EXTS:
+            return True, url, ext
 
-def _is_image_file(fname):
+    host = parts.netloc.lower()
+    if host.startswith("www."):
+        host = host[4:]
+    for regex, handler in HOST_RULES.get(host, ()):
+        match = regex.match(path)
+        if match is not None:
+            return handler(match)
+
+    return False, url, None
+
+def resolve_imgur_album(api_url, client_id):
     """
-    Check if given file is an image file.
+    Get the (url, dims) of the first PNG or JPEG image of an imgur album.
+
+    Returns None if there is no such image or imgur can't be reached.
     """
 
-    if not isfile(fname):
-        return False
+    if api_url in ALBUMS:
+        return ALBUMS[api_url]
 
-    cmd = ["file", fname]
+    headers = {"Authorization": "Client-ID " + client_id}
+    resp = _req_get(api_url, headers=headers)
+    if resp is None or resp.status_code != 200:
+        log.warn("Getting imgur album {} failed!", api_url)
+        return None
+
+    image = None
     try:
-        out = check_output(cmd)
-    except CalledProcessError:
+        for img in resp.json()["data"]:
+            if img["type"] in IMAGE_CONTENT_TYPES:
+                image = img["link"], (img["width"], img["height"])
+                break
+    except (ValueError, KeyError, TypeError):
+        log.warn("Bad imgur album {}!", api_url)
+
+    ALBUMS[api_url] = image
+    return image
+
+def _is_image_data(data):
+    """
+    Check if data starts like a PNG or JPEG file.
+    """
+
+    return any(data.startswith(magic) for magic in IMAGE_MAGICS)
+
+def image_dims(data):
+    """
+    Get (width, height) from the PNG IHDR or JPEG SOF header in data.
+
+    Returns None if the header is not in data.
+    """
+
+    if data.startswith(IMAGE_MAGICS[0]):
+        if len(data) < 24 or data[12:16] != b"IHDR":
+            return None
+        width, height = struct.unpack(">II", data[16:24])
+        return width, height
+
+    if not data.startswith(IMAGE_MAGICS[1]):
+        return None
+
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos:pos + 1] != b"\xff":
+            return None
+        marker = ord(data[pos + 1:pos + 2])
+
+        # Fill bytes and markers without a segment
+        if marker == 0xFF:
+            pos += 1
+            continue
+        if marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:
+            pos += 2
+            continue
+
+        if marker in JPEG_SOF_MARKERS:
+            if pos + 9 > len(data):
+                return None
+            height, width = struct.unpack(">HH", data[pos + 5:pos + 9])
+            return width, height
+
+        seglen = struct.unpack(">H", data[pos + 2:pos + 4])[0]
+        pos += 2 + seglen
+
+    return None
+
+def preview_dims(post):
+    """
+    Get the (width, height) of the post's image from its preview.
+
+    Returns None if reddit didn't generate a preview.
+    """
+
+    try:
+        source = post["data"]["preview"]["images"][0]["source"]
+        return int(source["width"]), int(source["height"])
+    except (KeyError, IndexError, TypeError, ValueError):
+        return None
+
+class ScreenFit(object):
+    """
+    Check if an image of given dimensions suits a screen.
+
+    Images smaller than the screen or with a too different aspect ratio
+    are rejected; with no screen size known every image fits.
+    """
+
+    def __init__(self, size, tolerance=ASPECT_TOLERANCE):
+        self.size = size
+        self.tolerance = tolerance
+
+    def __call__(self, dims):
+        if self.size is None or dims is None:
+            return True
+
+        width, height = dims
+        swidth, sheight = self.size
+        if width < swidth or height < sheight:
+            return False
+
+        aspect = swidth / sheight
+        return abs(width / height - aspect) <= self.tolerance * aspect
+
+def _check_image_headers(resp):
+    """
+    Check the declared Content-Type and Content-Length of the response.
+    """
+
+    ctype = resp.headers.get("Content-Type", "")
+    ctype = ctype.split(";")[0].strip().lower()
+    if ctype and ctype not in IMAGE_CONTENT_TYPES:
+        log.warn("Not an image: {}", ctype)
         return False
 
-    if "PNG image data" in out or "JPEG image data" in out:
-        return True
+    length = resp.headers.get("Content-Length", "")
+    if length.isdigit() and int(length) > MAX_IMAGE_BYTES:
+        log.warn("Image too large: {} bytes", length)
+        return False
 
-    return False
+    return True
 
-def get_subreddit_images(subreddit, user_agent):
+def _trim_post(post):
     """
-    Get the images posted in a given subreddit.
+    Keep only the post fields we use.
+    """
+
+    data = post["data"]
+    trimmed = dict((k, data[k]) for k in POST_FIELDS if k in data)
+    trimmed["dims"] = preview_dims(post)
+    return {"data": trimmed}
 
-    subreddit - url of the subreddit's json file
-    user_agent - user agent strint to use for crawling reddit
+class ListingCache(object):
     """
+    Subreddit listings kept across update cycles.
 
-    headers = {"User-Agent": user_agent}
-    params = {"limit": 100}
+    Listings are refetched with the validators of the last response and
+    only the posts above the newest cached one are asked for. Since hot
+    listings get reordered, they are fetched in full every
+    LISTING_REFRESH seconds.
+    """
 
-    log.info("Getting pics from /r/{} ...", subreddit)
-    urlfmt = "http://www.reddit.com/r/{}/.json".format
-    posts = _req_get(urlfmt(subreddit), headers=headers, params=params)
-    if posts is None or posts.status_code != 200:
-        log.warn("Getting pics from /r/{} failed!", subreddit)
-        return []
+    def __init__(self, fname):
+        self.fname = fname
+        self.lock = threading.Lock()
+
+        # subreddit -> dict(etag, last_modified, fetched, posts)
+        self.listings = {}
+        self.load()
+
+    def load(self):
+        """
+        Load the saved listings.
+        """
+
+        if not isfile(self.fname):
+            return
+
+        try:
+            with open(self.fname) as fobj:
+                self.listings = json.load(fobj)
+        except ValueError:
+            log.warn("Ignoring corrupt listing cache")
+
+    def save(self):
+        """
+        Write out the listings.
+        """
+
+        with self.lock:
+            listings = dict(self.listings)
+        with aw.open(self.fname, "w") as fobj:
+            json.dump(listings, fobj)
+
+    def fetch(self, subreddit, user_agent):
+        """
+        Get the posts of the subreddit, updating the cached listing.
+
+        Falls back to the cached posts if reddit can't be reached.
+        """
+
+        with self.lock:
+            entry = self.listings.get(subreddit)
+
+        headers = {"User-Agent": user_agent}
+        params = {"limit": PAGE_SIZE}
+
+        now = time.time()
+        incremental = (entry is not None and entry["posts"]
+                       and now - entry["fetched"] < LISTING_REFRESH)
+        if incremental:
+            direction = "before"
+            params["before"] = entry["posts"][0]["data"]["name"]
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+        else:
+            direction = "after"
+
+        cached = entry["posts"] if entry is not None else []
+
+        log.info("Getting pics from /r/{} ...", subreddit)
+        url = "http://www.reddit.com/r/{}/.json".format(subreddit)
+        posts, resp = [], None
+        while True:
+            resp = _req_get(url, headers=headers, params=params)
+            if resp is not None and resp.status_code == 304:
+                log.info("Listing of /r/{} not modified", subreddit)
+                return cached
+            if resp is None or resp.status_code != 200:
+                log.warn("Getting pics from /r/{} failed!", subreddit)
+                return cached
+
+            try:
+                data = resp.json()["data"]
+                page = [_trim_post(p) for p in data["children"]]
+            except (ValueError, KeyError, TypeError):
+                log.warn("Bad listing for /r/{}!", subreddit)
+                return cached
+
+            # Pages before the anchor are newer than the previous ones
+            if direction == "before":
+                posts = page + posts
+            else:
+                posts = posts + page
+
+            anchor = data.get(direction)
+            if not anchor or not page or len(posts) >= LISTING_SIZE:
+                break
+
+            # Validators only apply to the first page
+            headers = {"User-Agent": user_agent}
+            params[direction] = anchor
+
+        if incremental:
+            log.info("Got {} new posts in /r/{}", len(posts), subreddit)
+            posts = posts + cached
+            fetched = entry["fetched"]
+        else:
+            fetched = now
+
+        entry = {
+            "etag": resp.headers.get("ETag"),
+            "last_modified": resp.headers.get("Last-Modified"),
+            "fetched": fetched,
+            "posts": posts[:LISTING_SIZE]
+        }
+        with self.lock:
+            self.listings[subreddit] = entry
+        return entry["posts"]
+
+def listing_images(posts, imgur_client_id=None):
+    """
+    Get the image urls from a listing's posts.
+
+    imgur albums are only used if an imgur API client id is given.
 
+    Returns a list of (url, dims); dims are None if not known.
+    """
+
+    images = []
     try:
-        posts = posts.json()["data"]["children"]
-        posts = filter(_not_over_18, posts)
-        urls  = map(_getimg, posts)
-        urls  = map(_transform_imgur, urls)
-        urls  = filter(_is_image_url, urls)
-    except (ValueError, KeyError):
+        for post in filter(_not_over_18, posts):
+            is_image, url, ext = classify_url(_getimg(post))
+            if is_image:
+                images.append((url, post["data"].get("dims")))
+            elif ext == ALBUM and imgur_client_id:
+                image = resolve_imgur_album(url, imgur_client_id)
+                if image is not None:
+                    images.append(image)
+    except KeyError:
         return []
 
-    return list(urls)
+    return images
+
+def get_all_images(subreddits, user_agent, listings, imgur_client_id=None):
+    """
+    Get the images posted in the subreddits, fetching them concurrently.
+
+    Returns a dict of url -> dims.
+    """
+
+    def get_images(subreddit):
+        posts = listings.fetch(subreddit, user_agent)
+        return listing_images(posts, imgur_client_id)
+
+    pool = ThreadPool(min(LISTING_WORKERS, len(subreddits)) or 1)
+    try:
+        images = pool.map(get_images, subreddits)
+    finally:
+        pool.close()
+
+    urls = {}
+    for us in images:
+        urls.update(us)
+    return urls
+
+class HostBreaker(object):
+    """
+    Per host circuit breaker for the image downloads.
+
+    A host that failed BREAKER_FAILURES times in a row is not tried
+    again until the breaker is reset, i.e. for the rest of the cycle.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.failures = {}
+
+    def reset(self):
+        """
+        Close all the breakers.
+        """
+
+        with self.lock:
+            self.failures.clear()
+
+    def allow(self, host):
+        """
+        Check if host may be tried.
+        """
+
+        with self.lock:
+            return self.failures.get(host, 0) < BREAKER_FAILURES
+
+    def failure(self, host):
+        """
+        Note a failed request to host.
+        """
+
+        with self.lock:
+            self.failures[host] = self.failures.get(host, 0) + 1
+            if self.failures[host] == BREAKER_FAILURES:
+                log.warn("Giving up on {} for this cycle", host)
+
+    def success(self, host):
+        """
+        Note a successful request to host.
+        """
+
+        with self.lock:
+            self.failures.pop(host, None)
+
+BREAKER = HostBreaker()
+
+def backoff_delay(attempt):
+    """
+    Get the jittered delay before the given retry.
+    """
+
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempt - 1))
+    return random.uniform(delay / 2, delay)
+
+def _download_part(url, part, fits=None):
+    """
+    Download the image in url to part, resuming a partial download.
+
+    Returns True when done, False if the image is not wanted and None
+    if the download should be retried.
+    """
+
+    offset = os.path.getsize(part) if isfile(part) else 0
+    headers = {"Range": "bytes=%d-" % offset} if offset else {}
+    resp = _req_get(url, stream=True, headers=headers)
+
+    if resp is None:
+        return None
+    if resp.status_code == 429 or resp.status_code >= 500:
+        log.warn("Downloading failed with {}", resp.status_code)
+        resp.close()
+        return None
+
+    try:
+        crange = resp.headers.get("Content-Range", "")
+        if offset and resp.status_code == 416:
+            # Range starts at the end; the part may already be complete
+            if crange == "bytes */%d" % offset:
+                return True
+            log.warn("Partial download is stale; starting over")
+            os.remove(part)
+            return None
+        elif offset and resp.status_code == 206:
+            if not crange.startswith("bytes %d-" % offset):
+                log.warn("Got range {!r} instead; starting over", crange)
+                os.remove(part)
+                return None
+            log.info("Resuming from byte {} ...", offset)
+        elif resp.status_code == 200:
+            # Server ignored the range; start over
+            offset = 0
+        else:
+            log.warn("Downloading failed with {}", resp.status_code)
+            return False
+
+        if not _check_image_headers(resp):
+            return False
+
+        chunks = resp.iter_content(CHUNK_SIZE)
+        data = next(chunks, b"")
+
+        # Check the magic bytes before downloading the rest
+        if offset == 0:
+            if not _is_image_data(data):
+                log.warn("Not a PNG or JPEG image!")
+                return False
+            if fits is not None and not fits(image_dims(data)):
+                log.info("Image doesn't fit the screen: {}",
+                         image_dims(data))
+                return False
+
+        log.info("Saving to {} ...", part)
+        size = offset
+        with open(part, "ab" if offset else "wb") as fobj:
+            while data:
+                size += len(data)
+                if size > MAX_IMAGE_BYTES:
+                    log.warn("Image larger than {} bytes!", MAX_IMAGE_BYTES)
+                    return False
+                fobj.write(data)
+                data = next(chunks, b"")
+    except (requests.RequestException, IOError):
+        log.warn("Downloading interrupted!", exc_info=True)
+        return None
+    finally:
+        resp.close()
 
-def download_image(url, fname):
+    return True
+
+def download_image(url, fname, fits=None):
     """
     Download the image in url to the given file.
+
+    If given, fits is called with the image dimensions, read from the
+    first streamed bytes, and the download is abandoned if it fails.
+    Interrupted downloads are kept in fname.part and resumed when
+    retried, here with backoff or in a later cycle.
+
+    Returns True when done, False if the image is not wanted and None
+    if the download failed and may be retried later.
     """
 
     log.info("Downloading image from {} ...", url)
-    resp = _req_get(url)
+    host = urlparse(url).netloc
+    part = fname + ".part"
+
+    for attempt in range(DOWNLOAD_ATTEMPTS):
+        if not BREAKER.allow(host):
+            return None
+        if attempt:
+            time.sleep(backoff_delay(attempt))
+
+        done = _download_part(url, part, fits)
+        if done is None:
+            BREAKER.failure(host)
+            continue
 
-    if resp is not None and resp.status_code == 200:
-        log.info("Saving to {} ...", fname)
-        with open(fname, "wb") as fobj:
-            fobj.write(resp.content)
+        BREAKER.success(host)
+        if not done:
+            if isfile(part):
+                os.remove(part)
+            return False
+
+        os.rename(part, fname)
         return True
 
     log.warn("Downloading failed!")
-    return False
+    return None
+
+def url_digest(url):
+    """
+    Get the SHA-1 digest of the url.
+    """
 
-def set_nitrogen_bg(cfname, screen, ifname, mode="auto", bgcolor=None):
+    return hashlib.sha1(url.encode("utf-8")).digest()
+
+def image_fname(url, save_dir):
+    """
+    Create a unique filename for the url.
     """
-    Set the nitrogen background image.
 
-    cfname  - Location for nitrogen's configuration
-    screen  - Where to set the wall paper: fullscreen, screen1, screen2
-    ifname  - Image fname to use as background image
-    mode    - scaled, auto, centered
-    bgcolor - Background color for the desktop
+    uhash = binascii.hexlify(url_digest(url)).decode("ascii")
+    fname = "%s.%s" % (uhash, classify_url(url)[2] or "jpg")
+    return join(save_dir, fname)
+
+class SeenUrls(object):
     """
+    Append-only store of the urls that have been seen.
 
-    log.info("Setting background image in nitrogen ...")
+    The log holds fixed width (SHA-1 digest, time seen) records; seeing
+    a url again appends a new record. Expired and superseded records are
+    dropped when the log is compacted. A JSON list of urls, as written
+    by older versions, is imported.
+    """
 
-    # Setup the proper value of screen
-    screen = {
-        "fullscreen" : ":0.0",
-        "screen1"    : "xin_0",
-        "screen2"    : "xin_1"
-    }[screen]
+    RECORD = struct.Struct(">20sI")
 
-    # Setup poper value for mode
-    mode = {
-        "scaled"   : 0,
-        "auto"     : 4,
-        "centered" : 2
-    }[mode]
-    mode = str(mode)
+    # Compact when the log has this many times more records than urls
+    COMPACT_RATIO = 2
+
+    def __init__(self, fname, max_age):
+        self.fname = fname
+        self.max_age = max_age
+
+        # digest -> time seen
+        self.seen = {}
+        self.n_records = 0
+
+        self.load()
+        self.fobj = open(self.fname, "ab")
+
+    def load(self):
+        """
+        Load the unexpired records.
+        """
+
+        if not isfile(self.fname):
+            return
+
+        with open(self.fname, "rb") as fobj:
+            data = fobj.read()
+
+        urls = self.parse_json(data)
+        if urls is not None:
+            self.load_json(urls)
+            return
+
+        # A crash may have left a partial record at the end
+        size = self.RECORD.size
+        n_records = len(data) // size
+
+        oldest = time.time() - self.max_age
+        for i in range(n_records):
+            digest, seen_at = self.RECORD.unpack_from(data, i * size)
+            if seen_at >= oldest:
+                self.seen[digest] = max(seen_at, self.seen.get(digest, 0))
+        self.n_records = n_records
+
+        if len(data) % size or n_records > self.COMPACT_RATIO * len(self.seen):
+            self.compact()
+
+    @staticmethod
+    def parse_json(data):
+        """
+        Get the urls if data is in the old JSON list format, else None.
+        """
+
+        try:
+            urls = json.loads(data.decode("utf-8"))
+        except ValueError:
+            return None
+        return urls if isinstance(urls, list) else None
+
+    def load_json(self, urls):
+        """
+        Import the urls of the old JSON list format.
+
+        The old file is moved aside, to <fname>.old.
+        """
+
+        oldname = self.fname + ".old"
+        os.rename(self.fname, oldname)
+
+        log.info("Importing {} seen urls from {} ...", len(urls), oldname)
+        now = int(time.time())
+        for url in urls:
+            if isinstance(url, basestring):
+                self.seen[url_digest(url)] = now
+        self.compact()
+
+    def compact(self):
+        """
+        Rewrite the log with one record per url.
+        """
+
+        log.info("Compacting seen urls: {} records, {} urls ...",
+                 self.n_records, len(self.seen))
+        with aw.open(self.fname, "wb") as fobj:
+            for digest, seen_at in sorted(self.seen.items()):
+                fobj.write(self.RECORD.pack(digest, seen_at))
+        self.n_records = len(self.seen)
+
+    def __contains__(self, url):
+        return url_digest(url) in self.seen
+
+    def add(self, url):
+        """
+        Mark the url as seen now.
+        """
+
+        digest = url_digest(url)
+        seen_at = int(time.time())
+
+        self.seen[digest] = seen_at
+        self.fobj.write(self.RECORD.pack(digest, seen_at))
+        self.n_records += 1
+
+    def close(self):
+        """
+        Flush the log, compacting it if needed.
+        """
+
+        self.fobj.close()
+        if self.n_records > self.COMPACT_RATIO * len(self.seen):
+            self.compact()
+
+class ImageCache(object):
+    """
+    Index of the downloaded images in save_dir.
 
-    # Read the config
-    conf = ConfigParser()
-    conf.read(cfname)
+    Keeps the url, size, last use time and dimensions of every image.
+    Images older than max_age are evicted, as are the least recently
+    used ones while the total size is over max_bytes.
+    """
 
-    # Fix in the stuff to fill in
-    conf.set(screen, "file", ifname)
-    conf.set(screen, "mode", mode)
-    if bgcolor is not None:
-        conf.set(screen, "bgcolor", bgcolor)
+    def __init__(self, save_dir, max_bytes, max_age):
+        self.save_dir = save_dir
+        self.index_fname = join(save_dir, "index.json")
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.load()
+
+    def load(self):
+        """
+        Load the index, syncing it with the files in save_dir.
+        """
+
+        entries = {}
+        if isfile(self.index_fname):
+            try:
+                with open(self.index_fname) as fobj:
+                    entries = json.load(fobj)
+            except ValueError:
+                log.warn("Ignoring corrupt cache index")
+
+        names = set(os.listdir(self.save_dir))
+        self.entries = dict((k, v) for k, v in entries.items() if k in names)
+
+        # Adopt images saved before we had an index
+        now = time.time()
+        for name in names:
+            if name in self.entries:
+                continue
+
+            # Partial downloads are resumed later unless they are stale
+            if name.endswith(".part"):
+                fname = join(self.save_dir, name)
+                if now - getmtime(fname) > PART_MAX_AGE:
+                    os.remove(fname)
+                continue
+            if name.rsplit(".", 1)[-1].lower() not in IMAGE_EXTS:
+                continue
+
+            fname = join(self.save_dir, name)
+            if not self.add(None, fname, getmtime(fname)):
+                os.remove(fname)
+
+    def save(self):
+        """
+        Write out the index.
+        """
+
+        with self.lock:
+            entries = dict(self.entries)
+        with aw.open(self.index_fname, "w") as fobj:
+            json.dump(entries, fobj)
+
+    def add(self, url, fname, last_used=None):
+        """
+        Add a downloaded image; returns False if it is not an image.
+        """
+
+        if last_used is None:
+            last_used = time.time()
+
+        with open(fname, "rb") as fobj:
+            header = fobj.read(HEADER_BYTES)
+        if not _is_image_data(header):
+            return False
+
+        entry = {
+            "url": url,
+            "size": os.path.getsize(fname),
+            "last_used": last_used,
+            "dims": image_dims(header)
+        }
+        with self.lock:
+            self.entries[basename(fname)] = entry
+        return True
 
-    # Write back config
-    with open(cfname, "w") as fobj:
-        conf.write(fobj)
+    def lookup(self, fname):
+        """
+        Check if the image fname is in the cache.
+        """
+
+        with self.lock:
+            entry = self.entries.get(basename(fname))
+        return entry is not None and isfile(fname)
+
+    def touch(self, fname):
+        """
+        Mark the image fname as just used.
+        """
+
+        with self.lock:
+            entry = self.entries.get(basename(fname))
+            if entry is not None:
+                entry["last_used"] = time.time()
+
+    def dims(self, fname):
+        """
+        Get the dimensions of the cached image fname.
+        """
+
+        with self.lock:
+            entry = self.entries.get(basename(fname))
+        if entry is None or entry["dims"] is None:
+            return None
+        return tuple(entry["dims"])
+
+    def least_recently_used(self, fits=None):
+        """
+        Get the fitting image that was used longest ago.
+
+        Returns None if there is no such image in the cache.
+        """
+
+        with self.lock:
+            names = sorted(self.entries,
+                           key=lambda n: self.entries[n]["last_used"])
+        for name in names:
+            fname = join(self.save_dir, name)
+            if fits is not None and not fits(self.dims(fname)):
+                continue
+            if isfile(fname):
+                return fname
+        return None
+
+    def evict(self):
+        """
+        Remove the images that are too old or over the size budget.
+        """
+
+        now = time.time()
+        with self.lock:
+            names = sorted(self.entries,
+                           key=lambda n: self.entries[n]["last_used"])
+            total = sum(e["size"] for e in self.entries.values())
+
+            for name in names:
+                entry = self.entries[name]
+                if (total <= self.max_bytes
+                        and now - entry["last_used"] <= self.max_age):
+                    break
+
+                log.info("Evicting {} from cache ...", name)
+                try:
+                    os.remove(join(self.save_dir, name))
+                except OSError:
+                    pass
+                total -= entry["size"]
+                del self.entries[name]
+
+def fetch_image(url, cache, fits=None):
+    """
+    Get the image at url from cache or download it.
+
+    Returns the file name, False if the image is not wanted or None if
+    it couldn't be downloaded.
+    """
+
+    fname = image_fname(url, cache.save_dir)
+    if cache.lookup(fname):
+        if fits is not None and not fits(cache.dims(fname)):
+            return False
+        log.info("Using cached image {} ...", fname)
+        return fname
+
+    done = download_image(url, fname, fits)
+    if not done:
+        return done
+    cache.add(url, fname)
+    return fname
+
+def iter_images(urls, cache, fits=None):
+    """
+    Yield (url, fname) for the urls in order.
+
+    Up to PREFETCH images are downloaded ahead in the background;
+    fname is as returned by fetch_image.
+    """
+
+    pool = ThreadPool(PREFETCH)
+    pending = deque()
+    urls = iter(urls)
+    try:
+        while True:
+            while len(pending) < PREFETCH:
+                url = next(urls, None)
+                if url is None:
+                    break
+                res = pool.apply_async(fetch_image, (url, cache, fits))
+                pending.append((url, res))
+
+            if not pending:
+                return
+
+            url, res = pending.popleft()
+            yield url, res.get()
+    finally:
+        pool.close()
+
+def patch_ini(text, settings):
+    """
+    Set the keys of the sections in the text of an ini file.
+
+    settings - dict of section -> dict of key -> value
+
+    Other lines are kept as they are; missing keys and sections are
+    appended.
+    """
+
+    lines = text.splitlines()
+    out = []
+    todo = dict((sec, dict(keys)) for sec, keys in settings.items())
+
+    def flush(section):
+        for key, val in sorted(todo.get(section, {}).items()):
+            out.append("%s=%s" % (key, val))
+        todo.pop(section, None)
+
+    section = None
+    for line in lines:
+        stripped = line.strip()
+        if stripped.startswith("[") and stripped.endswith("]"):
+            # Keep the blank lines between sections after the new keys
+            blanks = []
+            while out and not out[-1].strip():
+                blanks.append(out.pop())
+            flush(section)
+            out.extend(blanks)
+            section = stripped[1:-1]
+        elif section in todo and "=" in stripped:
+            key = stripped.split("=", 1)[0].strip()
+            if key in todo[section]:
+                line = "%s=%s" % (key, todo[section].pop(key))
+        out.append(line)
+    flush(section)
+
+    for section in sorted(todo):
+        if out:
+            out.append("")
+        out.append("[%s]" % section)
+        flush(section)
+
+    return "\n".join(out) + "\n"
+
+def set_nitrogen_bgs(cfname, backgrounds, bgcolor=None):
+    """
+    Set the nitrogen background images of all the screens at once.
+
+    cfname      - Location for nitrogen's configuration
+    backgrounds - List of (screen, image fname, mode); screen is
+                  fullscreen, screen1 or screen2 and mode is scaled,
+                  auto or centered
+    bgcolor     - Background color for the desktop
+    """
+
+    log.info("Setting background images in nitrogen ...")
+
+    settings = {}
+    for screen, ifname, mode in backgrounds:
+        keys = {
+            "file": ifname,
+            "mode": str(NITROGEN_MODES[mode])
+        }
+        if bgcolor is not None:
+            keys["bgcolor"] = bgcolor
+        settings[NITROGEN_SCREENS[screen]] = keys
+
+    text = ""
+    if isfile(cfname):
+        with open(cfname, "r") as fobj:
+            text = fobj.read().decode("utf-8")
+
+    with aw.open(cfname, "w") as fobj:
+        fobj.write(patch_ini(text, settings).encode("utf-8"))
 
     # Call nitrogen restore to update
     call(["nitrogen", "--restore"])
 
-def set_background(screen, mode, cfg, statefile):
+def set_feh_bgs(screens, backgrounds, current=None, bgcolor=None):
     """
-    Try to set the desktop background.
+    Set the root window background directly with feh.
+
+    screens     - List of (screen, mode) of all the configured screens
+    backgrounds - List of (screen, image fname, mode) to set
+    current     - dict of screen -> image fname set now
+
+    feh gives the images to the xinerama screens in order and uses a
+    single mode for all of them, so screens without a new background
+    keep their current one. Returns False, setting nothing, if a screen
+    has neither.
     """
 
-    # Location of the state file
-    log.info("Getting image list ...")
-    state_update(SYMB_GET_IMG_LIST, statefile)
-    urls = []
-    for sub in cfg.wallpaper_subreddits:
-        us = get_subreddit_images(sub, cfg.user_agent)
-        urls.extend(us)
-    urls = set(urls)
+    log.info("Setting background images with feh ...")
 
-    # Load seen urls file
-    log.info("Checking which urls have already been seen ...")
-    if isfile(cfg.seenurls_fname):
-        with open(cfg.seenurls_fname) as fobj:
-            seen_urls = set(json.load(fobj))
+    new = dict((screen, (ifname, mode))
+               for screen, ifname, mode in backgrounds)
+    current = current or {}
+
+    images = []
+    for screen, mode in sorted(screens):
+        if screen in new:
+            ifname, mode = new[screen]
+        elif current.get(screen) is not None:
+            ifname = current[screen]
+        else:
+            log.warn("No background for {}; not calling feh", screen)
+            return False
+        images.append((screen, ifname, mode))
+
+    modes = set(mode for _, _, mode in images)
+    if len(modes) > 1:
+        log.warn("feh can't mix modes {}; using the first", sorted(modes))
+
+    cmd = ["feh", "--no-fehbg", FEH_MODES[images[0][2]]]
+    if bgcolor is not None:
+        cmd += ["--image-bg", bgcolor]
+
+    if any(screen == "fullscreen" for screen, _, _ in images):
+        ifname = [f for s, f, _ in images if s == "fullscreen"][0]
+        cmd += ["--no-xinerama", ifname]
     else:
-        seen_urls = set()
+        cmd += [ifname for _, ifname, _ in images]
+
+    call(cmd)
+    return True
+
+def set_backgrounds(cfg, backgrounds, current=None):
+    """
+    Set the chosen background images with the configured backend.
+
+    current - dict of screen -> image fname set now
+
+    Returns False if nothing was set.
+    """
+
+    if not backgrounds:
+        return False
+
+    if cfg.bg_backend == "feh":
+        return set_feh_bgs(cfg.screens, backgrounds, current)
+
+    set_nitrogen_bgs(cfg.nitrogen_conf_fname, backgrounds)
+    return True
+
+def screen_fit(screen, cfg):
+    """
+    Get the ScreenFit for the screen.
+    """
+
+    size = cfg.screen_sizes.get(screen)
+    return ScreenFit(tuple(size) if size else None, cfg.aspect_tolerance)
+
+def choose_cached_background(screen, cfg, cache):
+    """
+    Choose a background from the cache, rotating through the images.
+
+    Returns the image fname or None.
+    """
+
+    fname = cache.least_recently_used(screen_fit(screen, cfg))
+    if fname is None:
+        log.warn("No cached images either!")
+        return None
+
+    cache.touch(fname)
+    return fname
+
+def choose_background(screen, cfg, statefile, cache, seen_urls, images):
+    """
+    Choose the desktop background from one of the images.
+
+    images - dict of url -> dims, as returned by get_all_images
+
+    Returns the image fname or None.
+    """
+
+    # Probably offline
+    if not images:
+        log.warn("Got no images; using a cached one ...")
+        return choose_cached_background(screen, cfg, cache)
+
+    # Drop the images whose preview shows they don't fit
+    fits = screen_fit(screen, cfg)
+    urls = [url for url, dims in images.items() if fits(dims)]
+    log.info("{} of {} images may fit {}", len(urls), len(images), screen)
+    if not urls:
+        log.warn("No image fits; using a cached one ...")
+        return choose_cached_background(screen, cfg, cache)
 
     # Create unseen urls list
-    unseen_urls = urls - seen_urls
+    log.info("Checking which urls have already been seen ...")
+    unseen_urls = [url for url in urls if url not in seen_urls]
     if not unseen_urls:
         unseen_urls = urls
-    unseen_urls = list(unseen_urls)
     random.shuffle(unseen_urls)
 
-    for url in unseen_urls:
-        seen_urls.add(url)
-
-        # Create a unique filename for the url
-        uhash = hashlib.sha1(url.encode("utf-8")).hexdigest()
-        fname = "%s.%s" % (uhash, _getext(url))
-        fname = join(cfg.save_dir, fname)
-
-        # Download the image
-        state_update(SYMB_DOWNLOAD_IMG, statefile)
-        if not download_image(url, fname):
+    state_update(SYMB_DOWNLOAD_IMG, statefile)
+    for url, fname in iter_images(unseen_urls, cache, fits):
+        # Failed downloads are tried again next time
+        if fname is None:
             continue
-        if not _is_image_file(fname):
+
+        seen_urls.add(url)
+        if not fname:
             continue
 
-        # Set background
-        set_nitrogen_bg(cfg.nitrogen_conf_fname, screen, fname, mode)
-        break
+        cache.touch(fname)
+        return fname
 
-    # Dump updated seen urls
-    log.info("Writing down list of checked urls ...")
-    with aw.open(cfg.seenurls_fname, "w") as fobj:
-        json.dump(sorted(seen_urls), fobj)
+    # Probably offline, with the listings from the cache
+    log.warn("Couldn't get any image; using a cached one ...")
+    return choose_cached_background(screen, cfg, cache)
 
 def read_cfg(fname):
     """
@@ -303,11 +1311,257 @@ def read_cfg(fname):
     cfg = AttrDict(cfg)
 
     cfg.save_dir = abspath(cfg.save_dir)
+    cfg.setdefault("queue_dir", join(dirname(cfg.save_dir.rstrip("/")),
+                                     "queue"))
+    cfg.queue_dir = abspath(cfg.queue_dir)
+    cfg.setdefault("queue_size", 2)
     cfg.seenurls_fname = abspath(cfg.seenurls_fname)
+    cfg.setdefault("listings_fname",
+                   join(dirname(cfg.seenurls_fname), "listings.json"))
+    cfg.listings_fname = abspath(cfg.listings_fname)
     cfg.nitrogen_conf_fname = abspath(cfg.nitrogen_conf_fname)
 
+    cfg.setdefault("imgur_client_id", None)
+    cfg.setdefault("bg_backend", "nitrogen")
+    # Left empty (null) in the config these are off or take the default
+    cfg.screen_sizes = cfg.get("screen_sizes") or {}
+    if cfg.get("aspect_tolerance") is None:
+        cfg.aspect_tolerance = ASPECT_TOLERANCE
+    cfg.setdefault("seenurls_max_days", 90)
+    cfg.setdefault("cache_max_mb", 500)
+    cfg.setdefault("cache_max_days", 30)
+
     return cfg
 
+def prepare_image(fname, qfname, mode, size):
+    """
+    Put the image in the queue as qfname, ready to be set on a screen.
+
+    With mode auto the image is scaled and cropped to the screen size
+    if it is known and ImageMagick is installed; otherwise it is linked.
+
+    Returns False if the image couldn't be queued.
+    """
+
+    if isfile(qfname):
+        os.remove(qfname)
+
+    if mode == "auto" and size and HAVE_CONVERT:
+        log.info("Scaling {} to {}x{} ...", fname, *size)
+        geom = "%dx%d" % tuple(size)
+        cmd = ["convert", fname, "-resize", geom + "^",
+               "-gravity", "center", "-extent", geom,
+               "-quality", "95", qfname]
+        retcode, _ = run_command(cmd, CONVERT_TIMEOUT)
+        if retcode == 0:
+            return True
+        log.warn("Scaling {} failed with {}", fname, retcode)
+        if isfile(qfname):
+            os.remove(qfname)
+
+    try:
+        os.link(fname, qfname)
+    except OSError:
+        try:
+            shutil.copy(fname, qfname)
+        except (OSError, IOError):
+            log.warn("Can't queue {}!", fname, exc_info=True)
+            return False
+    return True
+
+class WallpaperQueue(object):
+    """
+    Wallpapers kept ready for the screens.
+
+    A producer thread fetches the listings, downloads the images and
+    prepares up to queue_size of them per screen in queue_dir; swapping
+    the wallpaper only takes the next ones from the queue.
+    """
+
+    def __init__(self, cfname, statefile):
+        self.cfname = cfname
+        self.statefile = statefile
+        self.cfg = read_cfg(cfname)
+
+        self.lock = threading.Lock()
+        self.wanted = threading.Event()
+
+        # screen -> deque of queued fnames
+        self.ready = {}
+
+        # screen -> queued fname currently set
+        self.current = {}
+
+        self.listings = None
+        self.listed_at = None
+        self.images = {}
+
+    def start(self):
+        """
+        Start the producer thread.
+        """
+
+        self.wanted.set()
+        thread = threading.Thread(target=self.run_producer, name="producer")
+        thread.daemon = True
+        thread.start()
+
+    def run_producer(self):
+        """
+        Fill the queue whenever there is room.
+
+        Queues left short by a failed fill are retried every FILL_RETRY
+        seconds.
+        """
+
+        while True:
+            self.wanted.wait(FILL_RETRY)
+            if not self.wanted.is_set() and self.is_full():
+                continue
+            self.wanted.clear()
+
+            with log.catch_exceptions():
+                self.fill()
+
+    def n_ready(self, screen):
+        """
+        Get the number of wallpapers ready for the screen.
+        """
+
+        with self.lock:
+            return len(self.ready.get(screen, ()))
+
+    def is_full(self):
+        """
+        Check if the queue of every screen is full.
+        """
+
+        cfg = self.cfg
+        return all(self.n_ready(screen) >= cfg.queue_size
+                   for screen, _ in cfg.screens)
+
+    def update_listings(self, cfg):
+        """
+        Get the listings once every update interval.
+        """
+
+        if self.listings is None or self.listings.fname != cfg.listings_fname:
+            self.listings = ListingCache(cfg.listings_fname)
+            self.listed_at = None
+
+        now = time.time()
+        if (self.listed_at is not None
+                and now - self.listed_at < cfg.update_interval * 60):
+            return
+
+        log.info("Getting image list ...")
+        state_update(SYMB_GET_IMG_LIST, self.statefile)
+        self.images = get_all_images(cfg.wallpaper_subreddits,
+                                     cfg.user_agent, self.listings,
+                                     cfg.imgur_client_id)
+        self.listings.save()
+        self.listed_at = now
+
+    def fill(self):
+        """
+        Prepare wallpapers till the queue of every screen is full.
+        """
+
+        # Reload config
+        cfg = read_cfg(self.cfname)
+        self.cfg = cfg
+        BREAKER.reset()
+
+        if not isdir(cfg.queue_dir):
+            os.makedirs(cfg.queue_dir, 0o700)
+
+        self.update_listings(cfg)
+
+        cache = ImageCache(cfg.save_dir,
+                           cfg.cache_max_mb * 1024 * 1024,
+                           cfg.cache_max_days * 86400)
+        seen_urls = SeenUrls(cfg.seenurls_fname,
+                             cfg.seenurls_max_days * 86400)
+
+        for screen, mode in cfg.screens:
+            while self.n_ready(screen) < cfg.queue_size:
+                fname = choose_background(screen, cfg, self.statefile,
+                                          cache, seen_urls, self.images)
+                if fname is None:
+                    break
+
+                # Only repeats are left, e.g. when offline
+                qfname = join(cfg.queue_dir, "%s%s-%s"
+                              % (QUEUE_PREFIX, screen, basename(fname)))
+                with self.lock:
+                    queued = (qfname in self.ready.get(screen, ())
+                              or qfname == self.current.get(screen))
+                if queued:
+                    break
+
+                size = cfg.screen_sizes.get(screen)
+                if not prepare_image(fname, qfname, mode, size):
+                    break
+
+                with self.lock:
+                    self.ready.setdefault(screen, deque()).append(qfname)
+
+        seen_urls.close()
+        cache.evict()
+        cache.save()
+
+        state_update(SYMB_SLEEPING, self.statefile)
+
+    def swap(self):
+        """
+        Set the next queued wallpapers.
+
+        Screens with none ready keep their wallpaper where the backend
+        allows it; otherwise the queued ones wait for the rest.
+        Returns False if none was set.
+        """
+
+        cfg = self.cfg
+
+        # Only this thread takes from the queues
+        backgrounds = []
+        with self.lock:
+            for screen, mode in cfg.screens:
+                queue = self.ready.get(screen)
+                if queue:
+                    backgrounds.append((screen, queue[0], mode))
+            current = dict(self.current)
+        if not set_backgrounds(cfg, backgrounds, current):
+            return False
+
+        for screen, fname, _ in backgrounds:
+            with self.lock:
+                self.ready[screen].popleft()
+                old = self.current.get(screen)
+                self.current[screen] = fname
+            if old is not None and isfile(old):
+                os.remove(old)
+
+        self.wanted.set()
+        return True
+
+def clean_queue_dir(queue_dir):
+    """
+    Remove the wallpapers queued in queue_dir, leaving other files.
+    """
+
+    if not isdir(queue_dir):
+        return
+
+    for name in os.listdir(queue_dir):
+        fname = join(queue_dir, name)
+        if not name.startswith(QUEUE_PREFIX) or not isfile(fname):
+            continue
+        try:
+            os.remove(fname)
+        except OSError:
+            log.warn("Can't remove {}", fname, exc_info=True)
+
 def do_main(statefile):
     """
     Run the actual code.
@@ -328,18 +1582,20 @@ def do_main(statefile):
         log.info("Creating image saving directory {} ...", cfg.save_dir)
         os.makedirs(cfg.save_dir, 0o700)
 
-    while True:
-        # Reload config
-        cfg = read_cfg(cfname)
+    # Wallpapers queued by an earlier instance
+    clean_queue_dir(cfg.queue_dir)
 
-        # Try to get set background
-        for screen, mode in cfg.screens:
-            set_background(screen, mode, cfg, statefile)
+    queue = WallpaperQueue(cfname, statefile)
+    queue.start()
+
+    # SIGUSR1 cuts the sleep short and so sets the next wallpaper
+    while True:
+        if not queue.swap():
+            time.sleep(QUEUE_POLL)
+            continue
 
-        # Go to sleep
-        log.info("Next update after {} minutes.", cfg.update_interval)
-        state_update(SYMB_SLEEPING, statefile)
-        time.sleep(cfg.update_interval * 60)
+        log.info("Next update after {} minutes.", queue.cfg.update_interval)
+        time.sleep(queue.cfg.update_interval * 60)
 
 def main():
     prio = 30
@@ -10,13 +10,14 @@ import time
 import socket
 import signal
 from datetime import datetime
-from subprocess import Popen, PIPE, STDOUT
+from subprocess import STDOUT
 
 import logbook
 
-from pbapps_common import do_main, dummy_handler, ICONS, COLORS
+from pbapps_common import do_main, run_command, Wakeup, ICONS, COLORS
 
 MODULE = "runbackup"
+PRIO = 60
 
 REPOSITORY = "/run/media/parantapa/backup1/ra_backup/workspace.borg"
 SRC_DIRS = [
@@ -25,8 +26,14 @@ SRC_DIRS = [
 ]
 SLEEP_TIME = 15
 
+# Time given to borg list; the disk may need to spin up
+LIST_TIMEOUT = 120
+
 log = logbook.Logger(MODULE)
 
+# Set on SIGUSR1 to cut the sleep short
+WAKE = Wakeup()
+
 SYMB_HDD = ICONS.fa_hdd_o
 SYMB_SLEEP = "%s: %s" % (SYMB_HDD, ICONS.fa_bed)
 SYMB_CHECK = "%s: %s" % (SYMB_HDD, ICONS.fa_spinner)
@@ -34,7 +41,7 @@ SYMB_WARN  = "%s: %s" % (SYMB_HDD, ICONS.fa_warn)
 SYMB_SAVE  = "%s: %s" % (SYMB_HDD, ICONS.fa_floppy_o)
 SYMB_PRUNE = "%s: %s" % (SYMB_HDD, ICONS.fa_scissors)
 
-def backup_iter():
+def blocks_iter():
     """
     Run actual backup code.
     """
@@ -43,22 +50,20 @@ def backup_iter():
 
     log.info("Sleeping for {} mins ...", SLEEP_TIME)
     yield [{"name": MODULE, "full_text": SYMB_SLEEP, "color": COLORS.green}]
-    time.sleep(SLEEP_TIME * 60)
+    WAKE.sleep(SLEEP_TIME * 60)
 
     while True:
         list_cmd = ["borg", "list", REPOSITORY]
         log.info("Check borg repo:\n{}", str(list_cmd))
         yield [{"name": MODULE, "full_text": SYMB_CHECK, "color": COLORS.green}]
-        proc = Popen(list_cmd, stdout=PIPE, stderr=STDOUT)
-        stdout, _ = proc.communicate()
-        retcode = proc.returncode
+        retcode, stdout = run_command(list_cmd, LIST_TIMEOUT, stderr=STDOUT)
         log.info("List repos completed with: {}\n{}", retcode, stdout)
 
         if retcode != 0:
             log.warn("Falied to confirm repo state")
             log.info("Sleeping for 1 min ...")
             yield [{"name": MODULE, "full_text": SYMB_WARN, "color": COLORS.red}]
-            time.sleep(60)
+            WAKE.sleep(60)
             continue
 
         timestamp = datetime.now()
@@ -74,9 +79,7 @@ def backup_iter():
         log.info("Running backup command:\n{}", str(backup_cmd))
         yield [{"name": MODULE, "full_text": SYMB_SAVE, "color": COLORS.green}]
         time.sleep(10)
-        proc = Popen(backup_cmd, stdout=PIPE, stderr=STDOUT)
-        stdout, _ = proc.communicate()
-        retcode = proc.returncode
+        retcode, stdout = run_command(backup_cmd, stderr=STDOUT)
         log.info("Backup completed with: {}\n{}", retcode, stdout)
 
         prune_cmd = ["borg", "prune",
@@ -90,19 +93,17 @@ def backup_iter():
         log.info("Running prune command:\n{}", str(prune_cmd))
         yield [{"name": MODULE, "full_text": SYMB_PRUNE, "color": COLORS.green}]
         time.sleep(10)
-        proc = Popen(prune_cmd, stdout=PIPE, stderr=STDOUT)
-        stdout, _ = proc.communicate()
-        retcode = proc.returncode
+        retcode, stdout = run_command(prune_cmd, stderr=STDOUT)
         log.info("Backup completed with: {}\n{}", retcode, stdout)
 
         log.info("Sleeping for {} mins ...", SLEEP_TIME)
         yield [{"name": MODULE, "full_text": SYMB_SLEEP, "color": COLORS.green}]
-        time.sleep(SLEEP_TIME * 60)
+        WAKE.sleep(SLEEP_TIME * 60)
 
 def main():
-    signal.signal(signal.SIGUSR1, dummy_handler)
+    signal.signal(signal.SIGUSR1, WAKE.handler)
 
-    do_main(MODULE, 60, backup_iter())
+    do_main(MODULE, PRIO, blocks_iter())
 
 if __name__ == '__main__':
     main()
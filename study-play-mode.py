@@ -13,14 +13,17 @@ __author__ = "Parantapa Bhattachara <pb [at] parantapa [dot] net>"
 import time
 import signal
 import json
+import threading
 
 import logbook
 
-from pbapps_common import do_main, fmt_period, \
-                          show_entry_dialog, \
+from pbapps_common import do_main, periodic_iter, fmt_period, \
+                          show_entry_dialog, Wakeup, \
                           ICONS, COLORS
 
 MODULE = "study-play-mode"
+PRIO = 20
+PERIOD = 2
 
 STUDY_ICON = ICONS.fa_graduation_cap
 PLAY_ICON = ICONS.fa_coffee
@@ -30,23 +33,14 @@ CUR_MODE_START = time.time()
 
 log = logbook.Logger(MODULE)
 
-def switch_mode(signum, frame): # pylint: disable=unused-argument
+# Set to show the mode right after a click switched it
+WAKE = Wakeup()
+
+def log_mode(last_mode, last_mode_start, last_mode_end):
     """
-    Swith the mode and reset mode start time.
+    Log the mode that just ended, asking for notes after study.
     """
 
-    global CUR_MODE, CUR_MODE_START
-
-    last_mode = CUR_MODE
-    last_mode_start = CUR_MODE_START
-
-    if CUR_MODE == "play":
-        CUR_MODE = "study"
-    else:
-        CUR_MODE = "play"
-
-    CUR_MODE_START = time.time()
-
     if last_mode == "study":
         title = "Notes"
         dialog_text = "What did you do last session?"
@@ -58,37 +52,76 @@ def switch_mode(signum, frame): # pylint: disable=unused-argument
     mode_log = {
         "mode": last_mode,
         "mode_start": last_mode_start,
-        "mode_end": CUR_MODE_START,
+        "mode_end": last_mode_end,
         "notes": notes
     }
     mode_log = json.dumps(mode_log)
     log.info("switched-mode {}", mode_log)
 
-def blocks_iter():
+def switch_mode(signum, frame): # pylint: disable=unused-argument
+    """
+    Swith the mode and reset mode start time.
+
+    The notes dialog is shown in a thread of its own so that the new
+    mode shows up right away.
+    """
+
+    global CUR_MODE, CUR_MODE_START
+
+    last_mode = CUR_MODE
+    last_mode_start = CUR_MODE_START
+
+    if CUR_MODE == "play":
+        CUR_MODE = "study"
+    else:
+        CUR_MODE = "play"
+
+    CUR_MODE_START = time.time()
+
+    thread = threading.Thread(target=log_mode,
+                              args=(last_mode, last_mode_start,
+                                    CUR_MODE_START))
+    thread.start()
+
+def on_usr1():
+    """
+    Switch the mode when running inside plugin-host.
+    """
+
+    switch_mode(signal.SIGUSR1, None)
+
+def on_click(event):
     """
-    Yield the blocks to send to i3status.
+    Switch the mode when the block is clicked.
     """
 
-    while True:
-        if CUR_MODE == "play":
-            icon = PLAY_ICON
-            color = COLORS.orange
-        else:
-            icon = STUDY_ICON
-            color = COLORS.cyan
+    if event.get("button") == 1:
+        switch_mode(signal.SIGUSR1, None)
+
+def get_blocks():
+    """
+    Get the blocks to send to i3status.
+    """
+
+    if CUR_MODE == "play":
+        icon = PLAY_ICON
+        color = COLORS.orange
+    else:
+        icon = STUDY_ICON
+        color = COLORS.cyan
 
-        runtime = time.time() - CUR_MODE_START
-        runtime = fmt_period(runtime)
+    runtime = time.time() - CUR_MODE_START
+    runtime = fmt_period(runtime)
 
-        yield [{"name": MODULE,
-                "full_text": "%s: %s" % (icon, runtime),
-                "color": color}]
-        time.sleep(2)
+    return [{"name": MODULE,
+             "full_text": "%s: %s" % (icon, runtime),
+             "color": color}]
 
 def main():
     signal.signal(signal.SIGUSR1, switch_mode)
 
-    do_main(MODULE, 20, blocks_iter())
+    blocks = periodic_iter(PERIOD, get_blocks, wake=WAKE)
+    do_main(MODULE, PRIO, blocks, on_click, WAKE)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python2
+# encoding: utf-8
+"""
+Show the cpu and memory usage history recorded by sys-state.
+"""
+
+from __future__ import division, print_function, unicode_literals
+
+__author__ = "Parantapa Bhattachara <pb [at] parantapa [dot] net>"
+
+import sys
+import time
+import argparse
+from datetime import datetime
+
+from pbapps_common import get_datadir, parse_period
+from pbapps_rrd import RRD
+
+def choose_step(rrd, since):
+    """
+    Get the finest step whose archive goes back far enough.
+    """
+
+    for step, rows in sorted(rrd.archives):
+        if step * rows >= since:
+            return step
+    return max(step for step, _ in rrd.archives)
+
+def parse_args():
+    """
+    Parse the command line arguments.
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--since", default="10m",
+                        help="how far back to go, e.g. '2h 30m' "
+                             "(default: %(default)s)")
+    parser.add_argument("--step", type=int, default=None,
+                        help="seconds per row; one of the archive steps "
+                             "(default: finest covering --since)")
+    parser.add_argument("--file", default=None,
+                        help="history file (default: the one sys-state "
+                             "writes)")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    try:
+        since = parse_period(args.since)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+
+    fname = args.file or "%s/sys-state.rrd" % get_datadir()
+    try:
+        rrd = RRD(fname)
+    except (IOError, OSError, ValueError) as e:
+        print("Can't read history: %s" % e)
+        sys.exit(1)
+
+    step = args.step or choose_step(rrd, since)
+    if step not in [s for s, _ in rrd.archives]:
+        print("No archive with step %d; have %s"
+              % (step, ", ".join(str(s) for s, _ in rrd.archives)))
+        sys.exit(1)
+
+    now = time.time()
+    rows = rrd.fetch(step, now - since, now)
+
+    fmt = "{:<19}" + " {:>7}" * len(rrd.fields)
+    print(fmt.format("time", *rrd.fields))
+    for bucket, values in rows:
+        stamp = datetime.fromtimestamp(bucket).strftime("%Y-%m-%d %H:%M:%S")
+        print(fmt.format(stamp, *["%.1f" % v for v in values]))
+
+    rrd.close()
+
+if __name__ == '__main__':
+    main()
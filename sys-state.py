@@ -8,17 +8,526 @@ from __future__ import division, print_function, unicode_literals
 
 __author__ = "Parantapa Bhattachara <pb [at] parantapa [dot] net>"
 
-import time
+import os
+import glob
+from array import array
 from datetime import datetime
 
 import psutil
+import logbook
 
-from pbapps_common import do_main, COLORS, ICONS
+from pbapps_common import do_main, periodic_iter, get_datadir, \
+                          COLORS, ICONS
+from pbapps_rrd import RRD
 
 MODULE = "sys-state"
+PRIO = 90
+PERIOD = 1
+
+# Tick on exact second boundaries so that the clock doesn't drift
+ALIGN = True
 
 SYMB_MEMORY = ICONS.fa_memory
 SYMB_CPU = ICONS.fa_cpu
+SYMB_DISK = ICONS.fa_hdd_o
+SYMB_NET = ICONS.fa_exchange
+SYMB_LOAD = ICONS.fa_tachometer
+SYMB_TEMP = ICONS.fa_thermometer
+
+# Bytes of /proc/stat read per cpu; the lines are well under this
+STAT_BYTES_PER_CPU = 256
+
+# Bytes of /proc/meminfo holding MemTotal and MemAvailable
+MEMINFO_BYTES = 512
+
+# Usage strings indexed by the rounded percentage
+PCT_STRS = ["{:2d}%".format(u) for u in range(100)]
+
+# Samples kept per core and for memory
+HISTORY = 60
+
+# Samples shown in the sparklines
+SPARK_WIDTH = 8
+SPARKS = "▁▂▃▄▅▆▇█"
+
+# With more cores the cpu block shows a histogram of their usages
+MAX_CORES_SHOWN = 16
+
+# Metrics recorded in the history file; see sys-state-history
+RRD_FIELDS = ("cpu", "mem")
+
+# Only block devices backed by hardware count as disks; stacked ones
+# (dm-*, md*) and virtual ones (loop, zram) would count the I/O twice
+# or not at all
+DISK_TEST = "/sys/block/%s/device"
+
+# Bytes per sector in /proc/diskstats
+SECTOR_SIZE = 512
+
+# Temperature shown in red from this many degrees C
+HOT_TEMP = 80
+
+THERMAL_GLOB = "/sys/class/thermal/thermal_zone*/temp"
+
+log = logbook.Logger(MODULE)
+
+class ProcSampler(object):
+    """
+    Sample the cpu and memory usage straight from /proc.
+
+    The files are kept open and re-read into reused buffers; the per
+    core counters are kept in arrays.
+    """
+
+    def __init__(self):
+        self.stat = open("/proc/stat", "rb", 0)
+        self.meminfo = open("/proc/meminfo", "rb", 0)
+        self.membuf = bytearray(MEMINFO_BYTES)
+        self.statbuf = bytearray(0)
+
+        self.ncpu = 0
+        self.prev_total = array("d")
+        self.prev_idle = array("d")
+        self.usages = array("d")
+
+        self.cpu_percent()
+
+    def read_cpu_lines(self):
+        """
+        Get the per cpu lines of /proc/stat.
+        """
+
+        while True:
+            self.stat.seek(0)
+            n = self.stat.readinto(self.statbuf)
+            data = self.statbuf[:n]
+
+            # The per cpu lines are followed by the intr line
+            end = data.find(b"\nintr ")
+            if end >= 0 or n < len(self.statbuf):
+                break
+            self.statbuf = bytearray(len(self.statbuf) * 2 + 4096)
+
+        lines = data[:end].split(b"\n")
+        return [l for l in lines if l[3:4].isdigit()]
+
+    def resize(self, ncpu):
+        """
+        Reset the counters for ncpu cpus.
+        """
+
+        self.ncpu = ncpu
+        self.prev_total = array("d", [0.0] * ncpu)
+        self.prev_idle = array("d", [0.0] * ncpu)
+        self.usages = array("d", [0.0] * ncpu)
+        self.statbuf = bytearray((ncpu + 2) * STAT_BYTES_PER_CPU)
+
+    def cpu_percent(self):
+        """
+        Get the per cpu usage percentages since the last call.
+        """
+
+        lines = self.read_cpu_lines()
+        if len(lines) != self.ncpu:
+            self.resize(len(lines))
+            lines = self.read_cpu_lines()
+
+        prev_total, prev_idle = self.prev_total, self.prev_idle
+        usages = self.usages
+        for i, line in enumerate(lines):
+            # user nice system idle iowait irq softirq steal
+            vals = line.split(None, 9)[1:9]
+            idle = int(vals[3]) + int(vals[4])
+            total = sum(int(v) for v in vals)
+
+            dtotal = total - prev_total[i]
+            didle = idle - prev_idle[i]
+            if dtotal > 0:
+                usages[i] = 100.0 * (dtotal - didle) / dtotal
+            else:
+                usages[i] = 0.0
+            prev_total[i] = total
+            prev_idle[i] = idle
+
+        return usages
+
+    def mem_percent(self):
+        """
+        Get the percentage of memory in use.
+        """
+
+        self.meminfo.seek(0)
+        n = self.meminfo.readinto(self.membuf)
+
+        total, avail = None, None
+        for line in self.membuf[:n].split(b"\n"):
+            if line.startswith(b"MemTotal:"):
+                total = int(line.split()[1])
+            elif line.startswith(b"MemAvailable:"):
+                avail = int(line.split()[1])
+        if not total or avail is None:
+            return psutil.virtual_memory().percent
+
+        return 100.0 * (total - avail) / total
+
+class Ring(object):
+    """
+    Ring buffer of the last size samples of nseries series.
+
+    Samples are stored in place in a single array; pushing a sample
+    does not allocate.
+    """
+
+    def __init__(self, nseries, size):
+        self.nseries = nseries
+        self.size = size
+        self.data = array("d", [0.0] * (nseries * size))
+        self.pos = 0
+        self.count = 0
+
+    def put(self, series, value):
+        """
+        Set the value of the series in the current sample.
+        """
+
+        self.data[series * self.size + self.pos] = value
+
+    def put_all(self, values):
+        """
+        Set the values of the first len(values) series.
+        """
+
+        data, size, pos = self.data, self.size, self.pos
+        for i in xrange(len(values)):
+            data[i * size + pos] = values[i]
+
+    def last(self, series):
+        """
+        Get the value of the series in the last finished sample.
+        """
+
+        return self.data[series * self.size + (self.pos - 1) % self.size]
+
+    def advance(self):
+        """
+        Finish the current sample.
+        """
+
+        self.pos = (self.pos + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def recent(self, series, n):
+        """
+        Iterate over the last n values of the series, oldest first.
+        """
+
+        n = min(n, self.count)
+        base, size = series * self.size, self.size
+        for k in xrange(self.pos - n, self.pos):
+            yield self.data[base + k % size]
+
+    def stats(self, series):
+        """
+        Get (min, avg, max) of the series.
+        """
+
+        lo, hi, total = 100.0, 0.0, 0.0
+        for value in self.recent(series, self.count):
+            lo = min(lo, value)
+            hi = max(hi, value)
+            total += value
+        return lo, total / max(1, self.count), hi
+
+def spark(value):
+    """
+    Get the sparkline character for a percentage.
+    """
+
+    idx = int(value * len(SPARKS) / 100.0)
+    return SPARKS[max(0, min(len(SPARKS) - 1, idx))]
+
+def sparkline(ring, series):
+    """
+    Render the recent values of the series with min/avg/max.
+    """
+
+    line = "".join([spark(v) for v in ring.recent(series, SPARK_WIDTH)])
+    return "{} {:.0f}/{:.0f}/{:.0f}".format(line, *ring.stats(series))
+
+def histogram(usages):
+    """
+    Render the distribution of the core usages.
+    """
+
+    counts = [0] * len(SPARKS)
+    for u in usages:
+        counts[min(len(SPARKS) - 1, int(u * len(SPARKS) / 100.0))] += 1
+
+    top = max(counts)
+    return "".join([spark(100.0 * c / top) if c else " " for c in counts])
+
+# Per core usages with the average as the last series
+CPU_HISTORY = None
+
+# Memory usage
+MEM_HISTORY = Ring(1, HISTORY)
+
+def reread(fobj, buf):
+    """
+    Read the whole file again into buf, growing it as needed.
+
+    Returns (data, buf).
+    """
+
+    while True:
+        fobj.seek(0)
+        n = fobj.readinto(buf)
+        if n < len(buf):
+            return buf[:n], buf
+        buf = bytearray(len(buf) * 2)
+
+class IOSampler(object):
+    """
+    Sample disk and network throughput, load and temperature in one go.
+
+    The files are kept open and rates are computed against the
+    counters of the previous sample using monotonic timestamps. The
+    disks are looked up again when /proc/diskstats lists a new device.
+    """
+
+    def __init__(self):
+        self.buf = bytearray(4096)
+
+        self.diskstats = open("/proc/diskstats", "rb", 0)
+        self.netdev = open("/proc/net/dev", "rb", 0)
+        self.loadavg = open("/proc/loadavg", "rb", 0)
+
+        self.disks = set()
+
+        # Devices in /proc/diskstats that are not disks, e.g. partitions
+        self.not_disks = set()
+
+        # Set when the disks change, as the counters then jump
+        self.rescanned = False
+        self.scan_disks()
+
+        self.zones = []
+        for fname in sorted(glob.glob(THERMAL_GLOB)):
+            try:
+                self.zones.append(open(fname, "rb", 0))
+            except IOError:
+                pass
+
+        self.prev_time = None
+        self.prev = array("d", [0.0] * 4)
+        self.cur = array("d", [0.0] * 4)
+
+        # disk read, disk write, net rx, net tx in bytes/s
+        self.rates = array("d", [0.0] * 4)
+
+    def scan_disks(self, name=None):
+        """
+        Get the disks from /sys/block.
+
+        If given, name is the device that prompted the scan.
+        """
+
+        names = os.listdir("/sys/block")
+        self.disks = set(d for d in names if os.path.exists(DISK_TEST % d))
+        self.not_disks.update(d for d in names if d not in self.disks)
+        if name is not None and name not in self.disks:
+            self.not_disks.add(name)
+        self.rescanned = True
+
+    def read_counters(self):
+        """
+        Read the disk and network byte counters into cur.
+        """
+
+        cur = self.cur
+        cur[0] = cur[1] = cur[2] = cur[3] = 0.0
+
+        data, self.buf = reread(self.diskstats, self.buf)
+        for line in data.split(b"\n"):
+            parts = line.split()
+            if len(parts) < 10:
+                continue
+
+            name = parts[2].decode("utf-8")
+            if name not in self.disks and name not in self.not_disks:
+                self.scan_disks(name)
+            if name not in self.disks:
+                continue
+            cur[0] += int(parts[5]) * SECTOR_SIZE
+            cur[1] += int(parts[9]) * SECTOR_SIZE
+
+        data, self.buf = reread(self.netdev, self.buf)
+        for line in data.split(b"\n")[2:]:
+            iface, _, counters = line.partition(b":")
+            parts = counters.split()
+            if len(parts) < 9 or iface.strip() == b"lo":
+                continue
+            cur[2] += int(parts[0])
+            cur[3] += int(parts[8])
+
+    def sample(self):
+        """
+        Take a sample; returns (rates, load, temperature).
+
+        Rates are None on the first sample and after the disks change;
+        temperature is None if there are no thermal zones.
+        """
+
+        # Elapsed real time in seconds, from times(2); unaffected by
+        # clock changes
+        now = os.times()[4]
+        self.read_counters()
+
+        rates = None
+        if (self.prev_time is not None and now > self.prev_time
+                and not self.rescanned):
+            elapsed = now - self.prev_time
+            for i in xrange(4):
+                self.rates[i] = max(0.0, self.cur[i] - self.prev[i]) / elapsed
+            rates = self.rates
+        self.prev_time = now
+        self.prev, self.cur = self.cur, self.prev
+        self.rescanned = False
+
+        data, self.buf = reread(self.loadavg, self.buf)
+        load = float(data.split(None, 1)[0])
+
+        temp = None
+        for zone in self.zones:
+            try:
+                data, self.buf = reread(zone, self.buf)
+                ztemp = int(data) / 1000
+            except (IOError, ValueError):
+                continue
+            temp = ztemp if temp is None else max(temp, ztemp)
+
+        return rates, load, temp
+
+def fmt_rate(rate):
+    """
+    Format a rate in bytes/s compactly.
+    """
+
+    for unit in "BKMG":
+        if rate < 999.5:
+            return "{:3.0f}{}".format(rate, unit)
+        rate /= 1024
+    return "{:3.0f}T".format(rate)
+
+SAMPLER = None
+
+IO_SAMPLER = None
+
+STORE = None
+
+def get_sampler():
+    """
+    Get the /proc sampler; None if /proc can't be read.
+    """
+
+    global SAMPLER
+
+    if SAMPLER is None:
+        try:
+            SAMPLER = ProcSampler()
+        except (IOError, OSError, ValueError, IndexError):
+            log.warn("Can't sample /proc; using psutil", exc_info=True)
+            SAMPLER = False
+
+    return SAMPLER or None
+
+def get_rrd_fname():
+    """
+    Get the file the metrics history is kept in.
+    """
+
+    return "%s/%s.rrd" % (get_datadir(), MODULE)
+
+def record_metrics():
+    """
+    Add the last samples to the metrics history.
+    """
+
+    global STORE
+
+    if STORE is None:
+        try:
+            STORE = RRD(get_rrd_fname(), RRD_FIELDS)
+        except (IOError, OSError, ValueError):
+            log.warn("Can't open the metrics history", exc_info=True)
+            STORE = False
+    if not STORE or CPU_HISTORY is None or not CPU_HISTORY.count:
+        return
+
+    STORE.update((CPU_HISTORY.last(CPU_HISTORY.nseries - 1),
+                  MEM_HISTORY.last(0)))
+
+def get_io_sampler():
+    """
+    Get the I/O sampler; None if /proc can't be read.
+    """
+
+    global IO_SAMPLER
+
+    if IO_SAMPLER is None:
+        try:
+            IO_SAMPLER = IOSampler()
+        except (IOError, OSError):
+            log.warn("Can't sample I/O", exc_info=True)
+            IO_SAMPLER = False
+
+    return IO_SAMPLER or None
+
+def get_iostate():
+    """
+    Get the disk, network, load and temperature blocks.
+    """
+
+    sampler = get_io_sampler()
+    if sampler is None:
+        return []
+
+    rates, load, temp = sampler.sample()
+
+    blocks = []
+    if rates is not None:
+        blocks.append({
+            "name": "disk_io",
+            "instance": 0,
+            "full_text": "{} {} {}".format(SYMB_DISK, fmt_rate(rates[0]),
+                                           fmt_rate(rates[1])),
+            "color": COLORS.green
+        })
+        blocks.append({
+            "name": "net_io",
+            "instance": 0,
+            "full_text": "{} {} {}".format(SYMB_NET, fmt_rate(rates[2]),
+                                           fmt_rate(rates[3])),
+            "color": COLORS.green
+        })
+
+    ncpu = CPU_HISTORY.nseries - 1 if CPU_HISTORY is not None else 1
+    blocks.append({
+        "name": "load",
+        "instance": 0,
+        "full_text": "{} {:.2f}".format(SYMB_LOAD, load),
+        "color": COLORS.green if load < ncpu else COLORS.red
+    })
+
+    if temp is not None:
+        blocks.append({
+            "name": "temperature",
+            "instance": 0,
+            "full_text": "{} {:.0f}°C".format(SYMB_TEMP, temp),
+            "color": COLORS.green if temp < HOT_TEMP else COLORS.red
+        })
+
+    return blocks
 
 def get_date():
     """
@@ -39,20 +548,48 @@ def get_cpuusage():
     Get the cpu usage.
     """
 
-    usages = psutil.cpu_percent(None, True)
+    global CPU_HISTORY
+
+    sampler = get_sampler()
+    if sampler is not None:
+        usages = sampler.cpu_percent()
+    else:
+        usages = psutil.cpu_percent(None, True)
 
-    avg_usage = sum(usages) / len(usages)
+    ncpu = len(usages)
+    if CPU_HISTORY is None or CPU_HISTORY.nseries != ncpu + 1:
+        # The first sample (after starting or cpus changing) is taken
+        # right after the counters were primed or reset, reading 0% or
+        # 100%; don't show or record it
+        CPU_HISTORY = Ring(ncpu + 1, HISTORY)
+        return [{
+            "name": "cpu_usage",
+            "instance": 0,
+            "full_text": "{} ..".format(SYMB_CPU),
+            "color": COLORS.green
+        }]
+
+    avg_usage = sum(usages) / ncpu
+    CPU_HISTORY.put_all(usages)
+    CPU_HISTORY.put(ncpu, avg_usage)
+    CPU_HISTORY.advance()
 
     color = COLORS.red if avg_usage >= 80 else COLORS.green
 
-    usages = [min(99.0, u) for u in usages]
-    usages = ["{:2.0f}%".format(u) for u in usages]
-    usages = " ".join(usages)
+    if ncpu <= MAX_CORES_SHOWN:
+        text = " ".join([PCT_STRS[min(99, int(u + 0.5))] for u in usages])
+    else:
+        # Busiest core over the history, as the histogram hides it
+        peak = max(CPU_HISTORY.stats(i)[1] for i in xrange(ncpu))
+        text = "{} [{}] ↑{}".format(PCT_STRS[min(99, int(avg_usage + 0.5))],
+                                    histogram(usages),
+                                    PCT_STRS[min(99, int(peak + 0.5))])
 
     return [{
         "name": "cpu_usage",
         "instance": 0,
-        "full_text": "{} {}".format(SYMB_CPU, usages),
+        "full_text": "{} {} {}".format(SYMB_CPU, text,
+                                       sparkline(CPU_HISTORY, ncpu)),
         "color":  color
     }]
 
@@ -61,30 +598,42 @@ def get_memusage():
     Get the memory usage.
     """
 
-    mem = psutil.virtual_memory()
-    usage = min(99.0, mem.percent)
+    sampler = get_sampler()
+    if sampler is not None:
+        usage = sampler.mem_percent()
+    else:
+        usage = psutil.virtual_memory().percent
+    usage = min(99.0, usage)
+
+    MEM_HISTORY.put(0, usage)
+    MEM_HISTORY.advance()
 
     return [{
         "name": "mem_usage",
         "instance": 0,
-        "full_text": "{} {:2.0f}%".format(SYMB_MEMORY, usage),
+        "full_text": "{} {:2.0f}% {}".format(SYMB_MEMORY, usage,
+                                             sparkline(MEM_HISTORY, 0)),
         "color": COLORS.green if usage < 80 else COLORS.red
     }]
 
-def blocks_iter():
-    while True:
-        blocks = []
+def get_blocks():
+    """
+    Get all the system state blocks.
+    """
+
+    blocks = []
 
-        blocks.extend(get_memusage())
-        blocks.extend(get_cpuusage())
-        blocks.extend(get_date())
+    blocks.extend(get_memusage())
+    blocks.extend(get_cpuusage())
+    blocks.extend(get_iostate())
+    blocks.extend(get_date())
 
-        yield blocks
+    record_metrics()
 
-        time.sleep(1)
+    return blocks
 
 def main():
-    do_main(MODULE, 90, blocks_iter())
+    do_main(MODULE, PRIO, periodic_iter(PERIOD, get_blocks, ALIGN))
 
 if __name__ == '__main__':
     main()
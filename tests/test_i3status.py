@@ -0,0 +1,206 @@
+# encoding: utf-8
+"""
+Check the routing of i3bar click events in i3status.
+
+Run with: python -m unittest discover tests
+"""
+
+from __future__ import division, print_function, unicode_literals
+
+import os
+import sys
+import imp
+import json
+import shutil
+import signal
+import tempfile
+import unittest
+from os.path import join, dirname, abspath, exists
+
+SRCDIR = dirname(dirname(abspath(__file__)))
+FIXTURES = join(dirname(abspath(__file__)), "fixtures", "i3status")
+
+sys.path.insert(0, SRCDIR)
+i3s = imp.load_source("i3status", join(SRCDIR, "i3status.py"))
+import pbapps_common as common
+
+def fixture(name):
+    """
+    Get the recorded input in the fixture file.
+    """
+
+    with open(join(FIXTURES, name), "rb") as fobj:
+        return fobj.read()
+
+class TestClickReader(unittest.TestCase):
+    """
+    Parse the click events i3bar writes to stdin.
+    """
+
+    def setUp(self):
+        rfd, self.wfd = os.pipe()
+        self.stdin = os.fdopen(rfd, "rb")
+        self.reader = i3s.ClickReader(self.stdin)
+
+    def tearDown(self):
+        self.stdin.close()
+        if self.wfd is not None:
+            os.close(self.wfd)
+
+    def test_events(self):
+        os.write(self.wfd, fixture("i3bar-clicks.txt"))
+        events = self.reader.read()
+        self.assertEqual([(e["name"], e["button"]) for e in events],
+                         [("volume", 1),
+                          ("volume", 4),
+                          ("40study-play-mode", 1)])
+        self.assertFalse(self.reader.closed)
+
+    def test_partial_line(self):
+        data = fixture("i3bar-clicks.txt")
+        cut = data.index(b"\n,") + 20
+        os.write(self.wfd, data[:cut])
+        self.assertEqual(len(self.reader.read()), 1)
+
+        os.write(self.wfd, data[cut:])
+        self.assertEqual(len(self.reader.read()), 2)
+
+    def test_closed(self):
+        os.close(self.wfd)
+        self.wfd = None
+        self.assertEqual(self.reader.read(), [])
+        self.assertTrue(self.reader.closed)
+
+class TempDirTest(unittest.TestCase):
+    """
+    Run the test in a temporary state directory.
+    """
+
+    def setUp(self):
+        self.extdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.extdir)
+
+    def write_service(self, service, pid, blocks):
+        with open(join(self.extdir, service + ".pid"), "w") as fobj:
+            fobj.write("%d\n" % pid)
+        with open(join(self.extdir, service + ".block"), "w") as fobj:
+            json.dump(blocks, fobj)
+
+def dead_pid():
+    """
+    Get the pid of a process that has exited.
+    """
+
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0) # pylint: disable=protected-access
+    os.waitpid(pid, 0)
+    return pid
+
+class TestBlockCacheOwner(TempDirTest):
+    """
+    Find the service owning a clicked block.
+    """
+
+    def setUp(self):
+        super(TestBlockCacheOwner, self).setUp()
+        self.pid = os.getpid()
+        self.write_service("20pulseaudio-state", self.pid,
+                           [{"name": "volume", "instance": "pulseaudio",
+                             "full_text": "50%"}])
+        self.write_service("40study-play-mode", self.pid,
+                           [{"full_text": "study"}])
+        self.write_service("50gone", dead_pid(), [{"full_text": "gone"}])
+        self.cache = i3s.BlockCache(self.extdir)
+        self.cache.read_blocks()
+
+    def test_named_block(self):
+        event = {"name": "volume", "instance": "pulseaudio", "button": 1}
+        self.assertEqual(self.cache.owner(event),
+                         ("20pulseaudio-state", self.pid))
+
+    def test_default_names(self):
+        # i3bar may send the instance back as a string
+        event = {"name": "40study-play-mode",
+                 "instance": "40study-play-mode-0", "button": 1}
+        self.assertEqual(self.cache.owner(event),
+                         ("40study-play-mode", self.pid))
+
+    def test_unknown_block(self):
+        event = {"name": "volume", "instance": "other", "button": 1}
+        self.assertIsNone(self.cache.owner(event))
+
+    def test_dead_service(self):
+        event = {"name": "50gone", "instance": "50gone-0", "button": 1}
+        self.assertIsNone(self.cache.owner(event))
+
+    def test_service_exited(self):
+        os.remove(join(self.extdir, "40study-play-mode.pid"))
+        self.cache.read_blocks()
+        event = {"name": "40study-play-mode",
+                 "instance": "40study-play-mode-0", "button": 1}
+        self.assertIsNone(self.cache.owner(event))
+
+class FakeClicks(object):
+    """
+    ClickReader returning the given events.
+    """
+
+    def __init__(self, events):
+        self.events = events
+
+    def read(self):
+        return self.events
+
+class TestDispatchClicks(TempDirTest):
+    """
+    Pass the clicks to the services taking them, with their own signal.
+    """
+
+    def setUp(self):
+        super(TestDispatchClicks, self).setUp()
+        self.signals = []
+        self.old_usr1 = signal.signal(signal.SIGUSR1, self.handler)
+        self.old_click = signal.signal(common.CLICK_SIGNAL, self.handler)
+
+        pid = os.getpid()
+        self.write_service("20pulseaudio-state", pid,
+                           [{"name": "volume", "instance": "pulseaudio"}])
+        self.write_service("30reddit-bg", pid, [{"full_text": "bg"}])
+        common.write_service_pid(self.extdir, 20, "pulseaudio-state", pid,
+                                 clicks=True)
+        self.cache = i3s.BlockCache(self.extdir)
+        self.cache.read_blocks()
+
+    def tearDown(self):
+        signal.signal(signal.SIGUSR1, self.old_usr1)
+        signal.signal(common.CLICK_SIGNAL, self.old_click)
+        super(TestDispatchClicks, self).tearDown()
+
+    def handler(self, signum, frame): # pylint: disable=unused-argument
+        self.signals.append(signum)
+
+    def test_clicks(self):
+        events = [{"name": "volume", "instance": "pulseaudio", "button": 1},
+                  {"name": "volume", "instance": "pulseaudio", "button": 5}]
+        i3s.dispatch_clicks(FakeClicks(events), self.cache)
+
+        self.assertEqual(self.signals, [common.CLICK_SIGNAL] * 2)
+        self.assertEqual(common.take_clicks(self.extdir,
+                                            "20pulseaudio-state"),
+                         events)
+        self.assertFalse(exists(join(self.extdir,
+                                     "20pulseaudio-state.signal")))
+
+    def test_not_clickable(self):
+        events = [{"name": "30reddit-bg", "instance": "30reddit-bg-0",
+                   "button": 1}]
+        i3s.dispatch_clicks(FakeClicks(events), self.cache)
+
+        self.assertEqual(self.signals, [])
+        self.assertFalse(exists(join(self.extdir, "30reddit-bg.click")))
+
+if __name__ == '__main__':
+    unittest.main()
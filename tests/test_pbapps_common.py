@@ -0,0 +1,133 @@
+# encoding: utf-8
+"""
+Check the click queue shared by i3status and the block producers.
+
+Run with: python -m unittest discover tests
+"""
+
+from __future__ import division, print_function, unicode_literals
+
+import os
+import sys
+import shutil
+import signal
+import tempfile
+import unittest
+from os.path import join, dirname, abspath, exists
+
+SRCDIR = dirname(dirname(abspath(__file__)))
+
+sys.path.insert(0, SRCDIR)
+import pbapps_common as common
+
+SERVICE = "40study-play-mode"
+
+class ClickTest(unittest.TestCase):
+    """
+    Run the test in a temporary state directory, counting the signals.
+    """
+
+    def setUp(self):
+        self.extdir = tempfile.mkdtemp()
+        self.signals = []
+        self.old_usr1 = signal.signal(signal.SIGUSR1, self.handler)
+        self.old_click = signal.signal(common.CLICK_SIGNAL, self.handler)
+
+    def tearDown(self):
+        signal.signal(signal.SIGUSR1, self.old_usr1)
+        signal.signal(common.CLICK_SIGNAL, self.old_click)
+        shutil.rmtree(self.extdir)
+
+    def handler(self, signum, frame): # pylint: disable=unused-argument
+        self.signals.append(signum)
+
+    def write_pid(self, clicks):
+        common.write_service_pid(self.extdir, 40, "study-play-mode",
+                                 os.getpid(), clicks=clicks)
+
+    def send_click(self, button):
+        return common.send_click(self.extdir, SERVICE, os.getpid(),
+                                 {"name": SERVICE, "button": button})
+
+class TestWriteServicePid(ClickTest):
+    """
+    Mark the services taking clicks.
+    """
+
+    def test_clicks(self):
+        self.write_pid(True)
+        self.assertTrue(exists(join(self.extdir, SERVICE + ".pid")))
+        self.assertTrue(exists(join(self.extdir, SERVICE + ".clickable")))
+
+    def test_stale_marker(self):
+        self.write_pid(True)
+        self.write_pid(False)
+        self.assertFalse(exists(join(self.extdir, SERVICE + ".clickable")))
+
+class TestSendClick(ClickTest):
+    """
+    Queue clicks for the services taking them.
+    """
+
+    def test_clickable(self):
+        self.write_pid(True)
+        self.assertTrue(self.send_click(1))
+        self.assertTrue(self.send_click(3))
+        self.assertEqual(self.signals, [common.CLICK_SIGNAL] * 2)
+        self.assertFalse(exists(join(self.extdir, SERVICE + ".signal")))
+
+    def test_not_clickable(self):
+        self.write_pid(False)
+        self.assertFalse(self.send_click(1))
+        self.assertEqual(self.signals, [])
+        self.assertFalse(exists(join(self.extdir, SERVICE + ".click")))
+
+class TestTakeClicks(ClickTest):
+    """
+    Take the queued clicks exactly once.
+    """
+
+    def setUp(self):
+        super(TestTakeClicks, self).setUp()
+        self.write_pid(True)
+
+    def take_buttons(self):
+        events = common.take_clicks(self.extdir, SERVICE)
+        return [event["button"] for event in events]
+
+    def test_in_order(self):
+        self.send_click(1)
+        self.send_click(4)
+        self.assertEqual(self.take_buttons(), [1, 4])
+        self.assertEqual(self.take_buttons(), [])
+        self.assertEqual(sorted(os.listdir(self.extdir)),
+                         [SERVICE + ".clickable", SERVICE + ".pid"])
+
+    def test_click_while_taking(self):
+        self.send_click(1)
+
+        # A click sent once the queue is taken starts a new one
+        clickfile = join(self.extdir, SERVICE + ".click")
+        rename = common.os.rename
+        def rename_and_click(src, dst):
+            rename(src, dst)
+            self.send_click(2)
+        common.os.rename = rename_and_click
+        try:
+            self.assertEqual(self.take_buttons(), [1])
+        finally:
+            common.os.rename = rename
+        self.assertTrue(exists(clickfile))
+
+        self.assertEqual(self.take_buttons(), [2])
+        self.assertEqual(self.signals, [common.CLICK_SIGNAL] * 2)
+
+    def test_bad_line(self):
+        self.send_click(1)
+        with open(join(self.extdir, SERVICE + ".click"), "a") as fobj:
+            fobj.write("{\"name\": \n")
+        self.send_click(2)
+        self.assertEqual(self.take_buttons(), [1, 2])
+
+if __name__ == '__main__':
+    unittest.main()
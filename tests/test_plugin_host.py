@@ -0,0 +1,121 @@
+# encoding: utf-8
+"""
+Check how plugin-host passes signals and clicks to its plugins.
+
+Run with: python -m unittest discover tests
+"""
+
+from __future__ import division, print_function, unicode_literals
+
+import os
+import sys
+import imp
+import json
+import types
+import shutil
+import tempfile
+import unittest
+from os.path import join, dirname, abspath, exists
+
+SRCDIR = dirname(dirname(abspath(__file__)))
+
+sys.path.insert(0, SRCDIR)
+ph = imp.load_source("plugin_host", join(SRCDIR, "plugin-host.py"))
+
+class FakePublisher(object):
+    """
+    BlockPublisher that keeps the blocks.
+    """
+
+    def __init__(self, extdir, prio, modname):
+        self.blocks = None
+
+    def publish(self, blocks):
+        self.blocks = blocks
+
+def fake_plugin(name, clicks):
+    """
+    Make a periodic plugin module recording its calls.
+    """
+
+    mod = types.ModuleType(str(name))
+    mod.MODULE = name
+    mod.PRIO = 40
+    mod.PERIOD = 60
+    mod.calls = []
+    mod.get_blocks = lambda: [{"full_text": name}]
+    mod.on_usr1 = lambda: mod.calls.append("usr1")
+    if clicks:
+        mod.on_click = lambda event: mod.calls.append(event["button"])
+    return mod
+
+class TestPluginHost(unittest.TestCase):
+    """
+    Keep the clicks apart from SIGUSR1.
+    """
+
+    def setUp(self):
+        self.extdir = tempfile.mkdtemp()
+        self.saved = ph.load_plugin, ph.BlockPublisher
+        mods = {"clicky": fake_plugin("clicky", True),
+                "plain": fake_plugin("plain", False)}
+        ph.load_plugin = mods.get
+        ph.BlockPublisher = FakePublisher
+        self.host = ph.PluginHost(["clicky", "plain"], self.extdir)
+        self.clicky, self.plain = self.host.plugins
+
+    def tearDown(self):
+        ph.load_plugin, ph.BlockPublisher = self.saved
+        os.close(self.host.wake_r)
+        os.close(self.host.wake_w)
+        shutil.rmtree(self.extdir)
+
+    def queue_click(self, plugin, button):
+        clickfile = "%s/%s.click" % (self.extdir, plugin.service)
+        with open(clickfile, "a") as fobj:
+            fobj.write(json.dumps({"button": button}) + "\n")
+
+    def signal_file(self, plugin):
+        with open("%s/%s.signal" % (self.extdir, plugin.service), "w"):
+            pass
+
+    def run_jobs(self, plugin):
+        """
+        Run the submitted jobs; returns the calls made.
+        """
+
+        while not plugin.jobs.empty():
+            action = plugin.jobs.get()
+            if action is not None:
+                action()
+        return plugin.mod.calls
+
+    def test_usr1_leaves_clicks(self):
+        self.queue_click(self.clicky, 1)
+        self.signal_file(self.clicky)
+        self.host.usr1_handler(None, None)
+        self.host.dispatch_usr1()
+
+        self.assertEqual(self.run_jobs(self.clicky), ["usr1"])
+        self.assertTrue(exists("%s/%s.click" % (self.extdir,
+                                                self.clicky.service)))
+
+    def test_clicks(self):
+        self.queue_click(self.clicky, 1)
+        self.queue_click(self.clicky, 3)
+        self.host.clicks_handler(None, None)
+        self.assertTrue(self.host.got_clicks)
+        self.host.collect_clicks()
+
+        self.assertFalse(self.host.got_clicks)
+        self.assertEqual(self.run_jobs(self.clicky), [1, 3])
+        self.assertTrue(self.plain.jobs.empty())
+
+    def test_not_clickable(self):
+        self.queue_click(self.plain, 1)
+        self.host.collect_clicks()
+        self.assertTrue(self.plain.jobs.empty())
+        self.assertEqual(self.plain.mod.calls, [])
+
+if __name__ == '__main__':
+    unittest.main()
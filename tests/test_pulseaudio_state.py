@@ -0,0 +1,126 @@
+# encoding: utf-8
+"""
+Check the parsing of recorded pactl/pacmd output in pulseaudio-state.
+
+Run with: python -m unittest discover tests
+"""
+
+from __future__ import division, print_function, unicode_literals
+
+import sys
+import imp
+import unittest
+from os.path import join, dirname, abspath
+
+SRCDIR = dirname(dirname(abspath(__file__)))
+FIXTURES = join(dirname(abspath(__file__)), "fixtures", "pulseaudio")
+
+sys.path.insert(0, SRCDIR)
+pa = imp.load_source("pulseaudio_state", join(SRCDIR, "pulseaudio-state.py"))
+
+def fixture(name):
+    """
+    Get the recorded output in the fixture file.
+    """
+
+    with open(join(FIXTURES, name), "rb") as fobj:
+        return fobj.read().decode("utf-8")
+
+class TestParsers(unittest.TestCase):
+    """
+    Parse the recorded output.
+    """
+
+    def test_list_sinks(self):
+        state = pa.parse_list_sinks(fixture("pacmd-list-sinks.txt"))
+        self.assertEqual(state, (45, True))
+
+    def test_list_sinks_no_default(self):
+        text = fixture("pacmd-list-sinks-no-default.txt")
+        self.assertIsNone(pa.parse_list_sinks(text))
+
+    def test_default_sink(self):
+        state = pa.parse_default_sink(fixture("pactl-get-sink-volume.txt"),
+                                      fixture("pactl-get-sink-mute.txt"))
+        self.assertEqual(state, (50, False))
+
+    def test_default_sink_error(self):
+        error = fixture("pactl-unknown-command.txt")
+        self.assertIsNone(pa.parse_default_sink(error, error))
+
+    def test_events(self):
+        lines = fixture("pactl-subscribe.txt").splitlines()
+        events = [pa.parse_event(line) for line in lines]
+        self.assertEqual(events, [("change", "sink"),
+                                  ("new", "sink-input"),
+                                  ("change", "source"),
+                                  ("remove", "sink-input"),
+                                  ("change", "server"),
+                                  ("new", "client")])
+
+    def test_bad_event(self):
+        self.assertIsNone(pa.parse_event(""))
+        self.assertIsNone(pa.parse_event("Got SIGINT, exiting."))
+
+class TestQueryDefaultSink(unittest.TestCase):
+    """
+    Fall back to pacmd only when pactl doesn't know the command.
+    """
+
+    def setUp(self):
+        self.saved = pa.run_commands, pa.run_command, pa.HAVE_GET_SINK
+        pa.HAVE_GET_SINK = True
+        pacmd = fixture("pacmd-list-sinks.txt").encode("utf-8")
+        pa.run_command = lambda *args, **kwargs: (0, pacmd)
+
+    def tearDown(self):
+        pa.run_commands, pa.run_command, pa.HAVE_GET_SINK = self.saved
+
+    def pactl(self, retcode, outs, err_name=None):
+        """
+        Make pactl exit with retcode and print outs and the fixture
+        err_name on stderr.
+        """
+
+        err = fixture(err_name).encode("utf-8") if err_name else b""
+
+        def run_commands(cmds, timeout=None, stderr=None):
+            stderr.write(err * len(cmds))
+            return [(retcode, out) for out in outs]
+
+        pa.run_commands = run_commands
+
+    def pactl_fails(self, name):
+        self.pactl(1, [b"", b""], name)
+
+    def test_get_sink(self):
+        outs = [fixture("pactl-get-sink-volume.txt").encode("utf-8"),
+                fixture("pactl-get-sink-mute.txt").encode("utf-8")]
+        self.pactl(0, outs)
+        self.assertEqual(pa.query_default_sink(), (50, False))
+        self.assertTrue(pa.HAVE_GET_SINK)
+
+    def test_get_sink_warning(self):
+        outs = [fixture("pactl-get-sink-volume.txt").encode("utf-8"),
+                fixture("pactl-get-sink-mute.txt").encode("utf-8")]
+        self.pactl(0, outs, "pactl-warning.txt")
+        self.assertEqual(pa.query_default_sink(), (50, False))
+        self.assertTrue(pa.HAVE_GET_SINK)
+
+    def test_unknown_command(self):
+        self.pactl_fails("pactl-unknown-command.txt")
+        self.assertEqual(pa.query_default_sink(), (45, True))
+        self.assertFalse(pa.HAVE_GET_SINK)
+
+    def test_transient_failure(self):
+        self.pactl_fails("pactl-connection-refused.txt")
+        pa.query_default_sink()
+        self.assertTrue(pa.HAVE_GET_SINK)
+
+    def test_timeout(self):
+        self.pactl(None, [b"", b""])
+        pa.query_default_sink()
+        self.assertTrue(pa.HAVE_GET_SINK)
+
+if __name__ == '__main__':
+    unittest.main()
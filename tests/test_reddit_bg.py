@@ -0,0 +1,280 @@
+# encoding: utf-8
+"""
+Check the wallpaper bookkeeping in reddit-bg.
+
+Run with: python -m unittest discover tests
+"""
+
+from __future__ import division, print_function, unicode_literals
+
+import os
+import sys
+import imp
+import json
+import shutil
+import tempfile
+import unittest
+from os.path import join, dirname, abspath, exists
+
+SRCDIR = dirname(dirname(abspath(__file__)))
+
+sys.path.insert(0, SRCDIR)
+rbg = imp.load_source("reddit_bg", join(SRCDIR, "reddit-bg.py"))
+
+class TempDirTest(unittest.TestCase):
+    """
+    Run the test in a temporary directory.
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+class TestSeenUrls(TempDirTest):
+    """
+    Load the seen urls log and the old JSON list.
+    """
+
+    def setUp(self):
+        super(TestSeenUrls, self).setUp()
+        self.fname = join(self.tmpdir, "seen-urls.bin")
+
+    def test_roundtrip(self):
+        seen = rbg.SeenUrls(self.fname, 86400)
+        seen.add("http://i.imgur.com/a.jpg")
+        seen.close()
+
+        seen = rbg.SeenUrls(self.fname, 86400)
+        self.assertIn("http://i.imgur.com/a.jpg", seen)
+        self.assertNotIn("http://i.imgur.com/b.jpg", seen)
+        seen.close()
+
+    def test_bracketed_log(self):
+        # A log that starts with "[" and ends with "]" is still a log
+        record = rbg.SeenUrls.RECORD
+        digests = [b"[" + b"a" * 19, b" " * 20, b"b" * 20]
+        seen_at = int(rbg.time.time()) // 256 * 256 + ord("]")
+        with open(self.fname, "wb") as fobj:
+            for digest in digests:
+                fobj.write(record.pack(digest, seen_at))
+
+        seen = rbg.SeenUrls(self.fname, 86400)
+        self.assertEqual(sorted(seen.seen), sorted(digests))
+        seen.close()
+        self.assertFalse(exists(self.fname + ".old"))
+
+    def test_json(self):
+        with open(self.fname, "w") as fobj:
+            json.dump(["http://i.imgur.com/a.jpg", 3], fobj)
+
+        seen = rbg.SeenUrls(self.fname, 86400)
+        self.assertIn("http://i.imgur.com/a.jpg", seen)
+        seen.close()
+        self.assertTrue(exists(self.fname + ".old"))
+
+        size = rbg.SeenUrls.RECORD.size
+        self.assertEqual(os.path.getsize(self.fname), size)
+
+class TestReadCfg(TempDirTest):
+    """
+    Read the config with optional keys left empty.
+    """
+
+    def read_cfg(self, cfg):
+        fname = join(self.tmpdir, "reddit-bg.conf.yaml")
+        with open(fname, "w") as fobj:
+            fobj.write("# parsed by the stub below\n")
+
+        load = rbg.yaml.load
+        rbg.yaml.load = lambda fobj: dict(cfg)
+        try:
+            return rbg.read_cfg(fname)
+        finally:
+            rbg.yaml.load = load
+
+    def test_null_screen_sizes(self):
+        cfg = self.read_cfg({
+            "save_dir": self.tmpdir,
+            "seenurls_fname": join(self.tmpdir, "seen-urls.bin"),
+            "nitrogen_conf_fname": "bg-saved.cfg",
+            "screens": [["screen1", "auto"]],
+            "screen_sizes": None,
+            "aspect_tolerance": None,
+        })
+        self.assertEqual(cfg.screen_sizes, {})
+        self.assertEqual(cfg.aspect_tolerance, rbg.ASPECT_TOLERANCE)
+
+        fits = rbg.screen_fit("screen1", cfg)
+        self.assertTrue(fits((640, 480)))
+
+class FakeResponse(object):
+    """
+    Streamed response with the given status, headers and body.
+    """
+
+    def __init__(self, status_code, headers=None, body=b""):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.body = body
+
+    def iter_content(self, size):
+        for i in range(0, len(self.body), size):
+            yield self.body[i:i + size]
+
+    def close(self):
+        pass
+
+class TestDownloadPart(TempDirTest):
+    """
+    Resume partial downloads.
+    """
+
+    IMAGE = b"\xff\xd8\xff" + b"x" * 97
+
+    def setUp(self):
+        super(TestDownloadPart, self).setUp()
+        self.part = join(self.tmpdir, "image.jpg.part")
+        self.req_get = rbg._req_get
+        self.requests = []
+
+    def tearDown(self):
+        rbg._req_get = self.req_get
+        super(TestDownloadPart, self).tearDown()
+
+    def respond(self, resp):
+        def req_get(url, **kwargs):
+            self.requests.append(kwargs.get("headers"))
+            return resp
+        rbg._req_get = req_get
+
+    def write_part(self, data):
+        with open(self.part, "wb") as fobj:
+            fobj.write(data)
+
+    def read_part(self):
+        with open(self.part, "rb") as fobj:
+            return fobj.read()
+
+    def test_resume(self):
+        self.write_part(self.IMAGE[:40])
+        self.respond(FakeResponse(206, {"Content-Range": "bytes 40-99/100"},
+                                  self.IMAGE[40:]))
+        self.assertTrue(rbg._download_part("http://x/a.jpg", self.part))
+        self.assertEqual(self.requests, [{"Range": "bytes=40-"}])
+        self.assertEqual(self.read_part(), self.IMAGE)
+
+    def test_range_ignored(self):
+        self.write_part(b"y" * 150)
+        self.respond(FakeResponse(200, {}, self.IMAGE))
+        self.assertTrue(rbg._download_part("http://x/a.jpg", self.part))
+        self.assertEqual(self.read_part(), self.IMAGE)
+
+    def test_wrong_range(self):
+        self.write_part(self.IMAGE[:40])
+        self.respond(FakeResponse(206, {"Content-Range": "bytes 0-99/100"},
+                                  self.IMAGE))
+        self.assertIsNone(rbg._download_part("http://x/a.jpg", self.part))
+        self.assertFalse(exists(self.part))
+
+    def test_already_complete(self):
+        self.write_part(self.IMAGE)
+        self.respond(FakeResponse(416, {"Content-Range": "bytes */100"}))
+        self.assertTrue(rbg._download_part("http://x/a.jpg", self.part))
+        self.assertEqual(self.read_part(), self.IMAGE)
+
+    def test_stale_part(self):
+        self.write_part(self.IMAGE)
+        self.respond(FakeResponse(416, {"Content-Range": "bytes */80"}))
+        self.assertIsNone(rbg._download_part("http://x/a.jpg", self.part))
+        self.assertFalse(exists(self.part))
+
+class TestSetFehBgs(unittest.TestCase):
+    """
+    Give feh one image per screen, in screen order.
+    """
+
+    SCREENS = [("screen2", "auto"), ("screen1", "auto")]
+
+    def setUp(self):
+        self.call = rbg.call
+        self.cmds = []
+        rbg.call = self.cmds.append
+
+    def tearDown(self):
+        rbg.call = self.call
+
+    def test_all_screens(self):
+        backgrounds = [("screen2", "b.jpg", "auto"),
+                       ("screen1", "a.jpg", "auto")]
+        self.assertTrue(rbg.set_feh_bgs(self.SCREENS, backgrounds))
+        self.assertEqual(self.cmds, [["feh", "--no-fehbg", "--bg-fill",
+                                      "a.jpg", "b.jpg"]])
+
+    def test_missing_screen(self):
+        backgrounds = [("screen2", "b.jpg", "auto")]
+        current = {"screen1": "old-a.jpg", "screen2": "old-b.jpg"}
+        self.assertTrue(rbg.set_feh_bgs(self.SCREENS, backgrounds, current))
+        self.assertEqual(self.cmds, [["feh", "--no-fehbg", "--bg-fill",
+                                      "old-a.jpg", "b.jpg"]])
+
+    def test_missing_screen_without_current(self):
+        backgrounds = [("screen2", "b.jpg", "auto")]
+        self.assertFalse(rbg.set_feh_bgs(self.SCREENS, backgrounds))
+        self.assertEqual(self.cmds, [])
+
+class TestWallpaperQueue(TempDirTest):
+    """
+    Swap in the queued wallpapers.
+    """
+
+    def setUp(self):
+        super(TestWallpaperQueue, self).setUp()
+        self.read_cfg = rbg.read_cfg
+        self.call = rbg.call
+        self.cmds = []
+        rbg.call = self.cmds.append
+
+        cfg = rbg.AttrDict(screens=[("screen1", "auto"),
+                                    ("screen2", "auto")],
+                           bg_backend="feh")
+        rbg.read_cfg = lambda fname: cfg
+        self.queue = rbg.WallpaperQueue("reddit-bg.conf.yaml", "state")
+
+    def tearDown(self):
+        rbg.read_cfg = self.read_cfg
+        rbg.call = self.call
+        super(TestWallpaperQueue, self).tearDown()
+
+    def test_partial_first_swap(self):
+        self.queue.ready["screen2"] = rbg.deque(["b.jpg"])
+        self.assertFalse(self.queue.swap())
+        self.assertEqual(self.cmds, [])
+        self.assertEqual(list(self.queue.ready["screen2"]), ["b.jpg"])
+
+        self.queue.ready["screen1"] = rbg.deque(["a.jpg"])
+        self.assertTrue(self.queue.swap())
+        self.assertEqual(self.cmds[-1][-2:], ["a.jpg", "b.jpg"])
+        self.assertEqual(self.queue.current,
+                         {"screen1": "a.jpg", "screen2": "b.jpg"})
+
+    def test_partial_swap(self):
+        self.queue.current = {"screen1": "a.jpg", "screen2": "b.jpg"}
+        self.queue.ready["screen2"] = rbg.deque(["c.jpg"])
+        self.assertTrue(self.queue.swap())
+        self.assertEqual(self.cmds[-1][-2:], ["a.jpg", "c.jpg"])
+
+    def test_clean_queue_dir(self):
+        names = [rbg.QUEUE_PREFIX + "screen1-a.jpg", "notes.txt"]
+        for name in names:
+            with open(join(self.tmpdir, name), "w"):
+                pass
+        os.mkdir(join(self.tmpdir, rbg.QUEUE_PREFIX + "dir"))
+
+        rbg.clean_queue_dir(self.tmpdir)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ["notes.txt", rbg.QUEUE_PREFIX + "dir"])
+
+if __name__ == '__main__':
+    unittest.main()
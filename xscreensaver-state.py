@@ -8,24 +8,30 @@ from __future__ import division, print_function, unicode_literals
 
 __author__ = "Parantapa Bhattachara <pb [at] parantapa [dot] net>"
 
-import time
-import subprocess as sub
+import os
 
-from pbapps_common import do_main, COLORS, ICONS
+from pbapps_common import do_main, periodic_iter, run_command, \
+                          COLORS, ICONS
 
 MODULE = "xscreensaver-state"
+PRIO = 85
+PERIOD = 2
 
-def get_xscreensaver_status(devnull):
+# Time given to xscreensaver-command before it is considered hung
+CMD_TIMEOUT = 2
+
+def get_xscreensaver_status():
     """
     Check if xscreensaver is running
     """
 
-    try:
-        cmd = ["xscreensaver-command", "-version"]
-        sub.check_call(cmd, stdout=devnull, stderr=devnull)
+    cmd = ["xscreensaver-command", "-version"]
+    with open(os.devnull, "w") as devnull:
+        retcode, _ = run_command(cmd, CMD_TIMEOUT, stderr=devnull)
 
+    if retcode == 0:
         color = COLORS.green
-    except sub.CalledProcessError:
+    else:
         color = COLORS.red
 
     return [{
@@ -34,15 +40,10 @@ def get_xscreensaver_status(devnull):
         "color": color
         }]
 
-def blocks_iter():
-    null = open("/dev/null", "w")
-
-    while True:
-        yield get_xscreensaver_status(null)
-        time.sleep(2)
+get_blocks = get_xscreensaver_status
 
 def main():
-    do_main(MODULE, 85, blocks_iter())
+    do_main(MODULE, PRIO, periodic_iter(PERIOD, get_blocks))
 
 if __name__ == '__main__':
     main()